@@ -0,0 +1,157 @@
+"""Local feed server producing synthetic RSS and Atom documents.
+
+Every path is a feed, e.g. ``/feeds/7.xml``. Query parameters control the
+document: ``items`` (entries per feed), ``size`` (approximate bytes of HTML
+per summary) and ``format`` (``rss`` or ``atom``). Responses carry an ETag
+and honour ``If-None-Match``. Calling :meth:`FakeFeedServer.publish` adds new
+entries to the top of every feed.
+
+    python -m benchmarks.fake_feeds --port 8081
+"""
+import argparse
+import datetime
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+BASE_TIME = 1_700_000_000
+FILLER = (
+    "<p>CISA is aware of active exploitation of <b>CVE-2024-0000</b> affecting "
+    "edge appliances. <img src='https://example.com/pixel.gif'/> Apply updates.</p>"
+)
+
+
+def _summary(feed: str, n: int, size: int) -> str:
+    head = f"<p>Advisory {n} from feed {feed}.</p>"
+    repeat = max(1, size // len(FILLER))
+    return head + FILLER * repeat
+
+
+def render_feed(feed: str, newest: int, items: int, size: int, fmt: str) -> bytes:
+    numbers = range(newest, max(newest - items, 0), -1)
+    if fmt == "atom":
+        entries = "".join(
+            f"<entry><title>Advisory {feed}-{n}</title>"
+            f"<link href='https://example.com/{feed}/{n}'/>"
+            f"<id>urn:{feed}:{n}</id>"
+            f"<updated>{_iso(n)}</updated>"
+            f"<summary type='html'><![CDATA[{_summary(feed, n, size)}]]></summary></entry>"
+            for n in numbers
+        )
+        doc = (
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<feed xmlns='http://www.w3.org/2005/Atom'>"
+            f"<title>Feed {feed}</title><id>urn:{feed}</id><updated>{_iso(newest)}</updated>"
+            f"{entries}</feed>"
+        )
+    else:
+        entries = "".join(
+            f"<item><title>Advisory {feed}-{n}</title>"
+            f"<link>https://example.com/{feed}/{n}</link>"
+            f"<guid>{feed}-{n}</guid>"
+            f"<pubDate>{formatdate(BASE_TIME + n * 60, usegmt=True)}</pubDate>"
+            f"<description><![CDATA[{_summary(feed, n, size)}]]></description></item>"
+            for n in numbers
+        )
+        doc = (
+            "<?xml version='1.0' encoding='utf-8'?><rss version='2.0'><channel>"
+            f"<title>Feed {feed}</title><link>https://example.com/{feed}</link>"
+            f"<description>Synthetic feed</description>{entries}</channel></rss>"
+        )
+    return doc.encode("utf-8")
+
+
+def _iso(n: int) -> str:
+    stamp = datetime.datetime.fromtimestamp(BASE_TIME + n * 60, tz=datetime.timezone.utc)
+    return stamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeFeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), latency: float = 0.0):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.newest = 100
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def feed_urls(self, count: int, items: int = 20, size: int = 500, fmt: str = "rss") -> List[str]:
+        return [
+            f"{self.base_url}/feeds/{i}.xml?items={items}&size={size}&format={fmt}"
+            for i in range(count)
+        ]
+
+    def publish(self, count: int = 1) -> None:
+        """Make ``count`` new entries appear at the top of every feed."""
+        with self._lock:
+            self.newest += count
+
+    def start(self) -> "FakeFeedServer":
+        threading.Thread(target=self.serve_forever, name="fake-feeds", daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server: FakeFeedServer = self.server
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        feed = parsed.path.rsplit("/", 1)[-1].split(".", 1)[0] or "0"
+        items = int(query.get("items", ["20"])[0])
+        size = int(query.get("size", ["500"])[0])
+        fmt = query.get("format", ["rss"])[0]
+        with server._lock:
+            server.requests += 1
+            newest = server.newest
+        if server.latency:
+            threading.Event().wait(server.latency)
+
+        etag = '"%s"' % hashlib.sha1(f"{self.path}:{newest}".encode()).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            with server._lock:
+                server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = render_feed(feed, newest, items, size, fmt)
+        content_type = "application/atom+xml" if fmt == "atom" else "application/rss+xml"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve synthetic RSS/Atom feeds")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    args = parser.parse_args()
+    server = FakeFeedServer((args.host, args.port), args.latency)
+    print(f"Fake feeds on {server.base_url}/feeds/<n>.xml?items=20&size=500&format=rss")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Local stand-in for the Ollama ``/api/generate`` streaming endpoint.
+
+Responses are streamed as newline-delimited JSON objects with a
+``response`` field, like Ollama does. ``latency`` delays the first token and
+``tokens_per_second`` paces the rest.
+
+    python -m benchmarks.fake_llm --port 11434 --latency 0.5 --tokens-per-second 40
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+WORDS = "threat actor exploited vulnerability in edge devices to deploy web shell".split()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        latency: float = 0.2,
+        tokens_per_second: float = 50.0,
+        tokens: int = 40,
+    ):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    def start(self) -> "FakeLLMServer":
+        threading.Thread(target=self.serve_forever, name="fake-llm", daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        server: FakeLLMServer = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with server._lock:
+            server.requests += 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(server.latency)
+        interval = 1.0 / server.tokens_per_second if server.tokens_per_second else 0
+        for i in range(server.tokens):
+            token = ("- " if i == 0 else "") + WORDS[i % len(WORDS)] + " "
+            line = {"model": body.get("model"), "response": token, "done": False}
+            self._chunk((json.dumps(line) + "\n").encode())
+            if interval:
+                time.sleep(interval)
+        self._chunk((json.dumps({"model": body.get("model"), "response": "", "done": True}) + "\n").encode())
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a fake Ollama /api/generate endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=40, help="Tokens per response")
+    args = parser.parse_args()
+    server = FakeLLMServer((args.host, args.port), args.latency, args.tokens_per_second, args.tokens)
+    print(f"Fake LLM listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Benchmarks for the ingest and serve hot paths.
+
+Each scenario runs against a throw-away ``articles.db`` and config file in a
+temporary directory, with the local fake LLM and fake feed servers standing in
+for Ollama and the feed hosts. Run from the repository root:
+
+    python -m benchmarks.run                      # every scenario
+    python -m benchmarks.run db_inserts feed_cycle --feeds 60
+    python -m benchmarks.run --output bench.json
+
+Results are printed as one JSON object per scenario.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import httpx
+
+import db
+import llm_client
+import settings
+from benchmarks.fake_feeds import FakeFeedServer
+from benchmarks.fake_llm import FakeLLMServer
+
+CONFIG_TEMPLATE = """
+[LLM]
+api_url = {llm_url}
+model_name = bench-model
+timeout = 60
+max_retries = 1
+max_in_flight = {max_in_flight}
+# The synthetic summaries share their filler text, so near-duplicate
+# detection would link nearly every article to one rewrite.
+duplicate_max_distance = -1
+rewrite_prompt = Summarize:\\n\\nTitle: {{title}}\\n\\n{{summary}}
+
+[RSS]
+feeds =
+{feeds}
+interval = 3600
+max_concurrency = {max_concurrency}
+per_host_concurrency = {max_concurrency}
+backfill = {backfill}
+max_new_entries = 20
+"""
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        "min": round(ordered[0], 4),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 4),
+        "mean": round(statistics.fmean(ordered), 4),
+    }
+
+
+def use_workspace(args, llm_url: str = "http://127.0.0.1:9/api/generate", feeds: List[str] = ()) -> Path:
+    """Point the app at a fresh database and config file."""
+    workdir = Path(tempfile.mkdtemp(prefix="feedpulse-bench-"))
+    config_path = workdir / "config.ini"
+    config_path.write_text(
+        CONFIG_TEMPLATE.format(
+            llm_url=llm_url,
+            max_in_flight=args.max_in_flight,
+            feeds="\n".join(f"    {url}" for url in feeds),
+            max_concurrency=args.max_concurrency,
+            backfill=args.backfill,
+        )
+    )
+    db.DB_PATH = workdir / "articles.db"
+    llm_client.DEFAULT_CONFIG_PATH = config_path
+    settings.CONFIG_PATH = config_path
+    return config_path
+
+
+def bench_db_inserts(args) -> dict:
+    use_workspace(args)
+    rows = [
+        {
+            "title": f"Benchmark article {i}",
+            "link": f"https://example.com/{i}",
+            "date": str(i),
+            "content": "- summary " * 20,
+        }
+        for i in range(args.rows)
+    ]
+    half = len(rows) // 2
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda r: db.store_processed_article(r["title"], r["link"], r["date"]), rows[:half]))
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(half, len(rows), args.batch):
+        db.store_processed_articles(rows[i:i + args.batch])
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(rows), args.batch):
+        db.store_rewritten_articles(rows[i:i + args.batch])
+    rewritten = time.perf_counter() - start
+
+    return {
+        "rows": len(rows),
+        "single_rows_per_sec": round(half / single, 1),
+        "batched_rows_per_sec": round((len(rows) - half) / batched, 1),
+        "rewritten_rows_per_sec": round(len(rows) / rewritten, 1),
+        "threads": args.threads,
+        "batch_size": args.batch,
+    }
+
+
+async def bench_feed_cycle(args) -> dict:
+    import feed_manager
+
+    feeds = FakeFeedServer(latency=args.feed_latency).start()
+    llm = FakeLLMServer(latency=args.llm_latency, tokens_per_second=args.tokens_per_second).start()
+    urls = feeds.feed_urls(args.feeds, items=args.items, size=args.size)
+    config_path = use_workspace(args, llm.url, urls)
+
+    async def timed_cycle() -> float:
+        start = time.perf_counter()
+        await feed_manager.run_async(config_path)
+        return round(time.perf_counter() - start, 4)
+
+    cold = await timed_cycle()
+    unchanged = await timed_cycle()
+    feeds.publish(args.publish)
+    updated = await timed_cycle()
+    result = {
+        "feeds": args.feeds,
+        "cold_cycle_s": cold,
+        "unchanged_cycle_s": unchanged,
+        "updated_cycle_s": updated,
+        "feed_requests": feeds.requests,
+        "feed_not_modified": feeds.not_modified,
+        "llm_requests": llm.requests,
+    }
+    feeds.shutdown()
+    llm.shutdown()
+    return result
+
+
+async def _load(
+    client: httpx.AsyncClient, paths: List[str], concurrency: int
+) -> Dict[str, object]:
+    gate = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(path: str) -> None:
+        nonlocal errors
+        async with gate:
+            start = time.perf_counter()
+            resp = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            if resp.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(p) for p in paths))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(paths),
+        "errors": errors,
+        "requests_per_sec": round(len(paths) / elapsed, 1),
+        "latency_s": percentiles(latencies),
+    }
+
+
+def _app_client() -> httpx.AsyncClient:
+    import main
+
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=None
+    )
+
+
+async def bench_summarize(args) -> dict:
+    feeds = FakeFeedServer(latency=args.feed_latency).start()
+    llm = FakeLLMServer(latency=args.llm_latency, tokens_per_second=args.tokens_per_second).start()
+    use_workspace(args, llm.url)
+    # Distinct feeds so that every request misses the feed and rewrite caches;
+    # the bench config turns off near-duplicate linking for the same reason.
+    urls = feeds.feed_urls(args.requests, items=args.items, size=args.size)
+    paths = [str(httpx.URL("/summarize", params={"rss_url": u, "limit": args.limit})) for u in urls]
+    async with _app_client() as client:
+        result = await _load(client, paths, args.concurrency)
+    result.update({"limit": args.limit, "concurrency": args.concurrency, "llm_requests": llm.requests})
+    feeds.shutdown()
+    llm.shutdown()
+    return result
+
+
+async def bench_api_articles(args) -> dict:
+    use_workspace(args)
+    rows = [
+        {
+            "title": f"Seeded article {i}",
+            "link": f"https://example.com/{i}",
+            "date": str(i),
+            "content": "- **CVE-2024-%04d** exploited by actor\n- patch now" % (i % 10000),
+        }
+        for i in range(args.articles)
+    ]
+    for i in range(0, len(rows), 1000):
+        db.store_rewritten_articles(rows[i:i + 1000])
+
+    rng = random.Random(0)
+    paths = []
+    for _ in range(args.requests):
+        if rng.random() < 0.5:
+            paths.append("/api/articles")
+        else:
+            paths.append(f"/api/articles?before_id={rng.randint(1, args.articles)}")
+    async with _app_client() as client:
+        result = await _load(client, paths, args.concurrency)
+    result.update({"articles": args.articles, "concurrency": args.concurrency})
+    return result
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "db_inserts": bench_db_inserts,
+    "feed_cycle": bench_feed_cycle,
+    "summarize": bench_summarize,
+    "api_articles": bench_api_articles,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run FeedPulse benchmarks")
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="scenario", help=f"One of {', '.join(SCENARIOS)} (default: all)"
+    )
+    parser.add_argument("--output", type=Path, help="Append results as JSON lines to this file")
+    parser.add_argument("--rows", type=int, default=20000, help="db_inserts: rows to insert")
+    parser.add_argument("--threads", type=int, default=16, help="db_inserts: writer threads")
+    parser.add_argument("--batch", type=int, default=100, help="db_inserts: rows per batch")
+    parser.add_argument("--feeds", type=int, default=60, help="feed_cycle: number of feeds")
+    parser.add_argument("--items", type=int, default=20, help="Entries per synthetic feed")
+    parser.add_argument("--size", type=int, default=500, help="Approximate summary size in bytes")
+    parser.add_argument("--publish", type=int, default=2, help="feed_cycle: new entries per feed")
+    parser.add_argument("--backfill", type=int, default=1)
+    parser.add_argument("--feed-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--max-concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent HTTP clients")
+    parser.add_argument("--limit", type=int, default=3, help="summarize: articles per request")
+    parser.add_argument("--articles", type=int, default=50000, help="api_articles: rows to seed")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING)
+    for name in args.scenarios or list(SCENARIOS):
+        bench = SCENARIOS[name]
+        result = bench(args)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
+        line = json.dumps({"scenario": name, **result})
+        print(line, flush=True)
+        if args.output:
+            with args.output.open("a") as fh:
+                fh.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
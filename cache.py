@@ -1,20 +1,167 @@
+import asyncio
+import sys
+import threading
 import time
-from typing import Any, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
 
-class SimpleCache:
-    def __init__(self, ttl: int = 600):
+
+def estimate_size(value: Any) -> int:
+    """Rough deep size in bytes of plain Python data (dicts, lists, strings)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+@dataclass
+class _Entry:
+    value: Any
+    expires: float
+    size: int
+
+
+class LRUCache:
+    """Bounded TTL cache with LRU eviction and single-flight loading.
+
+    The cache holds at most ``max_entries`` items and roughly ``max_bytes`` of
+    data as measured by :func:`estimate_size`. Expired entries are dropped on
+    access and by an optional background sweeper thread. Concurrent
+    :meth:`get_or_fetch` calls for the same missing key share one fetch.
+    """
+
+    def __init__(
+        self,
+        ttl: int = 600,
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        sweep_interval: float = 60,
+    ):
         self.ttl = ttl
-        self.store: dict[str, tuple[Any, float]] = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
 
     def get(self, key: str) -> Optional[Any]:
-        value = self.store.get(key)
-        if not value:
-            return None
-        data, expires = value
-        if time.time() > expires:
-            self.store.pop(key, None)
-            return None
-        return data
-
-    def set(self, key: str, value: Any):
-        self.store[key] = (value, time.time() + self.ttl)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.monotonic() > entry.expires:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def set(self, key: str, value: Any) -> None:
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                # Would evict everything else and still not fit.
+                return
+            self._data[key] = _Entry(value, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._data.pop(key)
+        self.bytes -= entry.size
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value or load it, coalescing concurrent misses.
+
+        The fetch runs in a task of its own that every caller, the first one
+        included, waits on through :func:`asyncio.shield`, so a caller that is
+        cancelled gives up its wait without cancelling the others.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._loaded(key, done))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def _loaded(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the error retrieved in case every caller was cancelled.
+            task.exception()
+
+    def sweep(self) -> int:
+        """Drop every expired entry and return how many were removed."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._data.items() if now > entry.expires]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def start_sweeper(self) -> None:
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="cache-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def _sweep_loop(self) -> None:
+        while not self._stop.wait(self.sweep_interval):
+            self.sweep()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,146 @@
+"""Exponential backoff and circuit breaking for flaky upstreams.
+
+Feeds keep their failure count and next retry time in ``feed_status`` and use
+:func:`backoff_delay` directly. The LLM endpoint is guarded in memory by a
+:class:`CircuitBreaker` shared by every client talking to it.
+"""
+import threading
+import time
+from typing import Dict
+
+from metrics import CIRCUIT_STATE
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit for {name} is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def backoff_delay(failures: int, base: float, cap: float) -> float:
+    """Seconds to wait after ``failures`` consecutive failures: base, 2x base, 4x base, ... up to ``cap``."""
+    if failures <= 0:
+        return 0.0
+    return min(cap, base * 2 ** min(failures - 1, 32))
+
+
+class CircuitBreaker:
+    """Closed, open and half-open states around one upstream.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast with :class:`CircuitOpen`. Once the backoff has passed a
+    single probe call is let through: success closes the circuit, failure
+    opens it again for twice as long, up to ``max_backoff``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        backoff: float = 30.0,
+        max_backoff: float = 600.0,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opens = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._state = CLOSED
+        self._set_state(CLOSED)
+
+    def configure(self, failure_threshold: int, backoff: float, max_backoff: float) -> None:
+        """Apply new thresholds; the current state and failure count are kept."""
+        with self._lock:
+            self.failure_threshold = failure_threshold
+            self.backoff = backoff
+            self.max_backoff = max_backoff
+
+    def _set_state(self, state: str) -> None:
+        self._state = state
+        CIRCUIT_STATE.labels(circuit=self.name).set(_STATE_VALUES[state])
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def available(self) -> bool:
+        """Whether :meth:`check` would currently let a call through."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                return time.monotonic() >= self._open_until
+            return not self._probing
+
+    def check(self) -> None:
+        """Raise :class:`CircuitOpen` unless a call may go ahead now."""
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            now = time.monotonic()
+            if self._state == OPEN and now >= self._open_until:
+                self._set_state(HALF_OPEN)
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpen(self.name, max(0.0, self._open_until - now))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opens = 0
+            self._probing = False
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opens += 1
+                self._open_until = time.monotonic() + backoff_delay(
+                    self._opens, self.backoff, self.max_backoff
+                )
+                self._probing = False
+                self._set_state(OPEN)
+
+    def release(self) -> None:
+        """Give up a probe that ended without a verdict, e.g. when cancelled."""
+        with self._lock:
+            self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(
+    name: str,
+    failure_threshold: int = 5,
+    backoff: float = 30.0,
+    max_backoff: float = 600.0,
+) -> CircuitBreaker:
+    """Return the process-wide breaker for ``name``, creating it on first use.
+
+    An existing breaker takes on the given thresholds, so a reloaded
+    configuration applies to it without losing its state.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, failure_threshold, backoff, max_backoff)
+        else:
+            breaker.configure(failure_threshold, backoff, max_backoff)
+        return breaker
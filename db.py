@@ -1,112 +1,668 @@
+"""Storage for articles, feed state, rewrite jobs and the rewrite cache.
+
+SQLite is the default backend and is implemented here. With
+``backend = postgresql`` in the ``[DATABASE]`` section of ``config.ini`` the
+public functions below delegate to :class:`pg_store.PostgresStore` instead,
+so callers never depend on the backend.
+"""
 import sqlite3
+import functools
 import hashlib
+import html
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+from configparser import ConfigParser
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Any, Callable, List, Dict, Optional, Tuple
+
+import events
+import simhash
+from circuit import backoff_delay
+from render import render_markdown
+from metrics import (
+    DB_COMMIT_OPS,
+    DB_COMMIT_SECONDS,
+    DB_WRITE_SECONDS,
+    NEAR_DUPLICATES,
+    REWRITE_CACHE_LOOKUPS,
+    timed,
+)
 
 DB_PATH = Path(__file__).resolve().parent / "articles.db"
+CONFIG_PATH = Path(__file__).resolve().parent / "config.ini"
 
-_conn = None
+SQLITE = "sqlite"
+POSTGRESQL = "postgresql"
 
-def get_conn():
-    global _conn
-    if _conn is None:
-        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        _conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS processed_articles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                link TEXT,
-                date TEXT,
-                hash TEXT UNIQUE
-            )
-            """
-        )
-        _conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS rewritten_articles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                link TEXT,
-                content TEXT,
-                date TEXT,
-                hash TEXT UNIQUE
-            )
-            """
+
+@dataclass
+class DatabaseConfig:
+    backend: str = SQLITE
+    dsn: str = ""
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_timeout: float = 30.0
+
+    @classmethod
+    def load(cls, path: Path = CONFIG_PATH, section: str = "DATABASE") -> "DatabaseConfig":
+        parser = ConfigParser(interpolation=None)
+        read = parser.read(path)
+        if not read:
+            raise FileNotFoundError(f"Config file not found: {path}")
+        backend = parser.get(section, "backend", fallback=cls.backend).strip().lower()
+        if backend not in (SQLITE, POSTGRESQL):
+            raise ValueError(f"Unknown database backend '{backend}' in [{section}] of {path}")
+        dsn = parser.get(section, "dsn", fallback=cls.dsn)
+        if backend == POSTGRESQL and not dsn:
+            raise ValueError(f"'dsn' must be set in [{section}] of {path} for PostgreSQL")
+        return cls(
+            backend=backend,
+            dsn=dsn,
+            pool_min_size=parser.getint(section, "pool_min_size", fallback=cls.pool_min_size),
+            pool_max_size=parser.getint(section, "pool_max_size", fallback=cls.pool_max_size),
+            pool_timeout=parser.getfloat(section, "pool_timeout", fallback=cls.pool_timeout),
         )
-        _conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS feed_status (
-                url TEXT PRIMARY KEY,
-                checked_at TEXT,
-                success INTEGER,
-                reason TEXT
+
+# Maximum number of queued write operations committed in one transaction
+WRITE_BATCH_SIZE = 256
+
+# Current Unix time with sub-second precision, in SQL
+_NOW_EPOCH = "(julianday('now') - 2440587.5) * 86400.0"
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS processed_articles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        link TEXT,
+        date TEXT,
+        hash TEXT UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewritten_articles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        link TEXT,
+        content TEXT,
+        date TEXT,
+        hash TEXT UNIQUE,
+        content_html TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_status (
+        url TEXT PRIMARY KEY,
+        checked_at TEXT,
+        success INTEGER,
+        reason TEXT,
+        failures INTEGER DEFAULT 0,
+        next_retry_at REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_validators (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewrite_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        content TEXT,
+        created_at REAL,
+        last_used_at REAL,
+        hits INTEGER DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS rewrite_cache_last_used ON rewrite_cache (last_used_at)",
+    """
+    CREATE TABLE IF NOT EXISTS feed_watermarks (
+        url TEXT PRIMARY KEY,
+        last_guid TEXT,
+        last_published REAL,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_schedule (
+        url TEXT PRIMARY KEY,
+        next_poll_at REAL,
+        interval REAL,
+        publish_interval REAL,
+        last_polled_at REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewrite_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hash TEXT UNIQUE,
+        source TEXT,
+        article TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        last_error TEXT,
+        created_at REAL,
+        updated_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS rewrite_jobs_status ON rewrite_jobs (status, lease_until)",
+    # SimHash of every article rewritten on its own, and its LSH buckets.
+    """
+    CREATE TABLE IF NOT EXISTS article_simhash (
+        hash TEXT PRIMARY KEY,
+        simhash INTEGER NOT NULL,
+        created_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS article_simhash_created ON article_simhash (created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS article_simhash_buckets (
+        bucket INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (bucket, hash)
+    ) WITHOUT ROWID
+    """,
+    # Near-duplicates that share the rewrite of the article they were matched to.
+    """
+    CREATE TABLE IF NOT EXISTS article_duplicates (
+        hash TEXT PRIMARY KEY,
+        duplicate_of TEXT NOT NULL,
+        link TEXT,
+        source TEXT,
+        distance INTEGER,
+        created_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS article_duplicates_of ON article_duplicates (duplicate_of)",
+    # Full-text index over rewritten_articles, kept in sync by triggers.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS rewritten_articles_fts USING fts5(
+        title, content, content='rewritten_articles', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS rewritten_articles_ai AFTER INSERT ON rewritten_articles BEGIN
+        INSERT INTO rewritten_articles_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS rewritten_articles_ad AFTER DELETE ON rewritten_articles BEGIN
+        INSERT INTO rewritten_articles_fts (rewritten_articles_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS rewritten_articles_au AFTER UPDATE OF title, content ON rewritten_articles BEGIN
+        INSERT INTO rewritten_articles_fts (rewritten_articles_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO rewritten_articles_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END
+    """,
+    # Version of the rewritten articles, bumped by triggers in the transaction
+    # that changes them, so readers can tell whether cached pages are current.
+    """
+    CREATE TABLE IF NOT EXISTS data_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at REAL
+    )
+    """,
+    f"""
+    INSERT OR IGNORE INTO data_version (name, version, updated_at)
+    VALUES ('articles', 1, {_NOW_EPOCH})
+    """,
+    *(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS rewritten_articles_version_{suffix}
+        AFTER {event} ON rewritten_articles BEGIN
+            UPDATE data_version SET version = version + 1, updated_at = {_NOW_EPOCH}
+            WHERE name = 'articles';
+        END
+        """
+        for suffix, event in (("ai", "INSERT"), ("ad", "DELETE"), ("au", "UPDATE"))
+    ),
+]
+
+# Columns added after a table was first released, as (table, column, type).
+# They are added to existing databases when the schema is ensured.
+_COLUMNS = [
+    ("rewritten_articles", "content_html", "TEXT"),
+    ("feed_status", "failures", "INTEGER DEFAULT 0"),
+    ("feed_status", "next_retry_at", "REAL"),
+]
+
+# Relative weight of title matches over body matches in search ranking
+SEARCH_TITLE_WEIGHT = 5.0
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready: set = set()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NORMAL is durable across application crashes in WAL mode and only
+    # fsyncs at checkpoints instead of on every commit.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    with _schema_lock:
+        if DB_PATH in _schema_ready:
+            return
+        conn.execute("BEGIN")
+        fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'rewritten_articles_fts'"
+        ).fetchone()
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        for table, column, kind in _COLUMNS:
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        if not fts_exists:
+            # Index the rows that predate the full-text table.
+            conn.execute(
+                "INSERT INTO rewritten_articles_fts (rewritten_articles_fts) VALUES ('rebuild')"
             )
-            """
-        )
-        _conn.commit()
-    return _conn
+        conn.execute("COMMIT")
+        _schema_ready.add(DB_PATH)
+
+
+def get_conn() -> sqlite3.Connection:
+    """Return this thread's read connection.
+
+    Every thread gets its own connection; WAL mode lets readers run while the
+    writer thread commits. Writes must go through :func:`_write`.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "key", None) != (os.getpid(), DB_PATH):
+        conn = _connect()
+        _ensure_schema(conn)
+        _local.conn = conn
+        _local.key = (os.getpid(), DB_PATH)
+    return conn
+
+
+_config: Optional[DatabaseConfig] = None
+_store: Any = None
+_store_pid: Optional[int] = None
+_store_lock = threading.Lock()
+
+
+def configure(config: DatabaseConfig) -> None:
+    """Use ``config`` instead of the ``[DATABASE]`` section of ``config.ini``."""
+    global _config, _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _config = config
+        _store = None
+
+
+def _backend() -> Any:
+    """Return the PostgreSQL store, or ``None`` when SQLite is used."""
+    global _config, _store, _store_pid
+    if _config is not None and _config.backend != POSTGRESQL:
+        return None
+    if _store is not None and _store_pid == os.getpid():
+        return _store
+    with _store_lock:
+        if _config is None:
+            _config = DatabaseConfig.load() if CONFIG_PATH.exists() else DatabaseConfig()
+        if _config.backend != POSTGRESQL:
+            return None
+        if _store is None or _store_pid != os.getpid():
+            # A forked worker must not share the parent's pooled connections.
+            from pg_store import PostgresStore
+
+            _store = PostgresStore(_config)
+            _store_pid = os.getpid()
+        return _store
+
+
+def _dispatch(func: Callable) -> Callable:
+    """Route a storage function to the configured backend's method of the same name."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        store = _backend()
+        if store is not None:
+            return getattr(store, func.__name__)(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+class _Writer:
+    """Single thread owning the write connection.
+
+    Operations are queued and committed in groups: whatever is waiting when
+    the thread wakes up runs inside one transaction, each op wrapped in a
+    savepoint so a failing op does not roll back its neighbours.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Tuple[Callable[[sqlite3.Connection], Any], Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._path: Optional[Path] = None
+
+    def submit(self, op: Callable[[sqlite3.Connection], Any]) -> Future:
+        self._ensure_started()
+        future: Future = Future()
+        if threading.current_thread() is self._thread:
+            # Nested write from inside an op: we already hold the transaction.
+            future.set_result(op(self._conn))
+            return future
+        self._queue.put((op, future))
+        return future
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # Fresh process (e.g. a forked Celery worker): the parent's thread
+            # and queue did not survive the fork.
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        self._conn = None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch) -> None:
+        conn = self._conn
+        results = []
+        start = time.perf_counter()
+        try:
+            if conn is None or self._path != DB_PATH:
+                # DB_PATH may be repointed, e.g. by the benchmarks.
+                self._path = DB_PATH
+                conn = self._conn = _connect()
+                _ensure_schema(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            for op, _ in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((True, op(conn)))
+                    conn.execute("RELEASE op")
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((False, exc))
+            conn.execute("COMMIT")
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+            DB_COMMIT_OPS.observe(len(batch))
+        except Exception as exc:
+            if conn is not None and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+        for (_, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+_writer = _Writer()
+
+
+def _write(op: Callable[[sqlite3.Connection], Any]) -> Any:
+    """Run ``op`` on the writer thread and wait for its commit."""
+    with timed(DB_WRITE_SECONDS, op=op.__qualname__.split(".")[0]):
+        return _writer.submit(op).result()
+
 
 def compute_hash(title: str, date: str) -> str:
     return hashlib.sha256(f"{title}{date}".encode("utf-8")).hexdigest()
 
+
+def _insert_processed(conn: sqlite3.Connection, title: str, link: str, date: str) -> bool:
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO processed_articles (title, link, date, hash) VALUES (?, ?, ?, ?)",
+        (title, link, date, compute_hash(title, date)),
+    )
+    return cur.rowcount == 1
+
+
+@_dispatch
 def store_processed_article(title: str, link: str, date: str) -> bool:
+    return _write(lambda conn: _insert_processed(conn, title, link, date))
+
+
+@_dispatch
+def store_processed_articles(articles: List[Dict[str, str]]) -> List[bool]:
+    """Mark several articles as processed in one transaction.
+
+    Returns one flag per article, ``False`` for those already seen.
+    """
+    if not articles:
+        return []
+
+    def op(conn: sqlite3.Connection) -> List[bool]:
+        return [
+            _insert_processed(conn, a["title"], a["link"], a.get("date", ""))
+            for a in articles
+        ]
+
+    return _write(op)
+
+
+@_dispatch
+def find_processed_hashes(hashes: List[str]) -> set:
+    """Return the subset of ``hashes`` already in ``processed_articles``."""
     conn = get_conn()
-    h = compute_hash(title, date)
-    try:
-        conn.execute(
-            "INSERT INTO processed_articles (title, link, date, hash) VALUES (?, ?, ?, ?)",
-            (title, link, date, h),
+    found = set()
+    # Stay well below SQLite's bound parameter limit.
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        cur = conn.execute(
+            f"SELECT hash FROM processed_articles WHERE hash IN ({placeholders})",
+            chunk,
         )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
+        found.update(row[0] for row in cur.fetchall())
+    return found
 
 
 def store_rewritten_article(title: str, link: str, content: str, date: str) -> bool:
-    conn = get_conn()
-    h = compute_hash(title, date)
-    try:
-        conn.execute(
-            "INSERT INTO rewritten_articles (title, link, content, date, hash) VALUES (?, ?, ?, ?, ?)",
-            (title, link, content, date, h),
+    return store_rewritten_articles(
+        [{"title": title, "link": link, "content": content, "date": date}]
+    ) == 1
+
+
+def _rewritten_rows(articles: List[Dict[str, str]]) -> List[tuple]:
+    # Rendering happens on the caller's thread, not the writer's.
+    return [
+        (
+            a["title"],
+            a["link"],
+            a["content"],
+            a.get("content_html") or render_markdown(a["content"]),
+            a.get("date", ""),
+            compute_hash(a["title"], a.get("date", "")),
         )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
+        for a in articles
+    ]
+
+
+def _insert_rewritten(conn: sqlite3.Connection, rows: List[tuple]) -> int:
+    # rowcount, unlike total_changes, leaves out the rows the FTS triggers write.
+    cur = conn.executemany(
+        """
+        INSERT OR IGNORE INTO rewritten_articles (title, link, content, content_html, date, hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    return cur.rowcount
+
+
+@_dispatch
+def store_rewritten_articles(articles: List[Dict[str, str]]) -> int:
+    """Insert rewritten articles with a single ``executemany``.
+
+    The Markdown content is rendered to sanitized HTML here, on the caller's
+    thread, and stored alongside it unless the article already carries its
+    ``content_html``. Duplicates are ignored; returns the number of rows
+    actually inserted. Subscribers of :mod:`events` are notified once the
+    rows are committed.
+    """
+    if not articles:
+        return 0
+    rows = _rewritten_rows(articles)
+    stored = _write(lambda conn: _insert_rewritten(conn, rows))
+    if stored:
+        events.publish()
+    return stored
+
 
+@_dispatch
 def get_rewritten_article(article_hash: str) -> Optional[Dict[str, str]]:
     conn = get_conn()
     cur = conn.execute(
-        "SELECT title, link, content, date FROM rewritten_articles WHERE hash = ?",
+        "SELECT title, link, content, date, content_html FROM rewritten_articles WHERE hash = ?",
         (article_hash,),
     )
     row = cur.fetchone()
     if row:
-        return {"title": row[0], "link": row[1], "content": row[2], "date": row[3]}
+        return {
+            "title": row[0],
+            "link": row[1],
+            "content": row[2],
+            "date": row[3],
+            "content_html": row[4],
+        }
     return None
 
 
-def list_rewritten_articles() -> List[Dict[str, str]]:
+@_dispatch
+def get_articles_version() -> Tuple[int, float]:
+    """Return the version of the rewritten articles and when it last changed.
+
+    The version grows with every insert, update and delete, whichever process
+    makes it.
+    """
+    row = get_conn().execute(
+        "SELECT version, updated_at FROM data_version WHERE name = 'articles'"
+    ).fetchone()
+    return row[0], row[1]
+
+
+@_dispatch
+def list_rewritten_articles(
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> List[Dict[str, str]]:
+    """Return rewritten articles newest first.
+
+    Pages are addressed by keyset: pass the smallest ``id`` of the previous
+    page as ``before_id`` to get the next ``limit`` rows. Without a ``limit``
+    every remaining row is returned. ``after_id`` keeps only articles stored
+    after the one with that ``id``.
+    """
     conn = get_conn()
-    cur = conn.execute(
-        "SELECT title, link, content, date FROM rewritten_articles ORDER BY id DESC"
-    )
-    rows = cur.fetchall()
+    query = "SELECT id, title, link, content, date, content_html FROM rewritten_articles"
+    conditions = []
+    params: list = []
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    cur = conn.execute(query, params)
     return [
-        {"title": row[0], "link": row[1], "content": row[2], "date": row[3]}
-        for row in rows
+        {
+            "id": row[0],
+            "title": row[1],
+            "link": row[2],
+            "content": row[3],
+            "date": row[4],
+            "content_html": row[5],
+        }
+        for row in cur.fetchall()
     ]
 
 
-def list_rewritten_articles_with_id() -> List[Dict[str, str]]:
+def _fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching every term.
+
+    Each term is quoted so that input like ``CVE-2024-3400`` or ``APT29's``
+    is searched literally instead of being parsed as FTS5 syntax; a trailing
+    ``*`` keeps its meaning as a prefix search.
+    """
+    terms = []
+    for term in text.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+@_dispatch
+def search_articles(query: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """Full-text search over rewritten articles, best matches first.
+
+    Each result carries a ``snippet`` of the matching content as escaped HTML
+    with the matched terms wrapped in ``<mark>``.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
     conn = get_conn()
     cur = conn.execute(
-        "SELECT id, title, link, content, date FROM rewritten_articles ORDER BY id DESC"
+        """
+        SELECT a.id, a.title, a.link, a.content, a.date, a.content_html,
+               snippet(rewritten_articles_fts, 1, char(2), char(3), '…', 24),
+               bm25(rewritten_articles_fts, ?, 1.0) AS rank
+        FROM rewritten_articles_fts
+        JOIN rewritten_articles AS a ON a.id = rewritten_articles_fts.rowid
+        WHERE rewritten_articles_fts MATCH ?
+        ORDER BY rank, a.id DESC
+        LIMIT ? OFFSET ?
+        """,
+        (SEARCH_TITLE_WEIGHT, match, limit, offset),
     )
-    rows = cur.fetchall()
     return [
         {
             "id": row[0],
@@ -114,40 +670,547 @@ def list_rewritten_articles_with_id() -> List[Dict[str, str]]:
             "link": row[2],
             "content": row[3],
             "date": row[4],
+            "content_html": row[5],
+            "snippet": html.escape(row[6]).replace("\x02", "<mark>").replace("\x03", "</mark>"),
+            "rank": row[7],
         }
-        for row in rows
+        for row in cur.fetchall()
     ]
 
 
+@_dispatch
+def backfill_rendered_html(batch_size: int = 200) -> int:
+    """Render stored articles that have no HTML yet.
+
+    Rows written before rendering moved to write time are converted in
+    batches; returns the number of rows updated.
+    """
+    conn = get_conn()
+    done = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            """
+            SELECT id, content FROM rewritten_articles
+            WHERE content_html IS NULL AND id > ?
+            ORDER BY id LIMIT ?
+            """,
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            return done
+        last_id = rows[-1][0]
+        rendered = [(render_markdown(content or ""), row_id) for row_id, content in rows]
+        _write(
+            lambda conn: conn.executemany(
+                "UPDATE rewritten_articles SET content_html = ? WHERE id = ?", rendered
+            )
+        )
+        done += len(rendered)
+
+
+@_dispatch
 def delete_rewritten_articles(ids: List[int]) -> None:
     if not ids:
         return
-    conn = get_conn()
     placeholders = ",".join("?" for _ in ids)
-    conn.execute(
-        f"DELETE FROM rewritten_articles WHERE id IN ({placeholders})",
-        ids,
+    _write(
+        lambda conn: conn.execute(
+            f"DELETE FROM rewritten_articles WHERE id IN ({placeholders})",
+            ids,
+        )
     )
-    conn.commit()
 
 
-def record_feed_status(url: str, success: bool, reason: str) -> None:
+@_dispatch
+def record_feed_status(
+    url: str,
+    success: bool,
+    reason: str,
+    retry_after: Optional[float] = None,
+    backoff: float = 300.0,
+    max_backoff: float = 86400.0,
+) -> float:
+    """Record the outcome of a fetch and return the seconds until the next try.
+
+    Consecutive failures back off exponentially from ``backoff`` up to
+    ``max_backoff``, or longer if the server sent a ``Retry-After``. A
+    success resets the count, so the first good fetch after the backoff
+    recovers the feed.
+    """
+
+    def op(conn: sqlite3.Connection) -> float:
+        row = conn.execute("SELECT failures FROM feed_status WHERE url = ?", (url,)).fetchone()
+        failures = 0 if success else (row[0] or 0 if row else 0) + 1
+        delay = 0.0 if success else max(backoff_delay(failures, backoff, max_backoff), retry_after or 0)
+        conn.execute(
+            """
+            INSERT INTO feed_status (url, checked_at, success, reason, failures, next_retry_at)
+            VALUES (?, datetime('now'), ?, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                checked_at = excluded.checked_at,
+                success = excluded.success,
+                reason = excluded.reason,
+                failures = excluded.failures,
+                next_retry_at = excluded.next_retry_at
+            """,
+            (url, int(success), reason, failures, time.time() + delay if delay else None),
+        )
+        return delay
+
+    return _write(op)
+
+
+@_dispatch
+def get_backed_off_feeds() -> List[str]:
+    """Return the failing feeds that should not be retried yet."""
     conn = get_conn()
-    conn.execute(
-        """
-        INSERT INTO feed_status (url, checked_at, success, reason)
-        VALUES (?, datetime('now'), ?, ?)
-        ON CONFLICT(url) DO UPDATE SET
-            checked_at = excluded.checked_at,
-            success = excluded.success,
-            reason = excluded.reason
+    cur = conn.execute(
+        "SELECT url FROM feed_status WHERE success = 0 AND next_retry_at > ?", (time.time(),)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+@_dispatch
+def get_feed_validators(url: str) -> Tuple[Optional[str], Optional[str]]:
+    """Return the stored ``(etag, last_modified)`` pair for a feed."""
+    conn = get_conn()
+    cur = conn.execute(
+        "SELECT etag, last_modified FROM feed_validators WHERE url = ?",
+        (url,),
+    )
+    row = cur.fetchone()
+    if row:
+        return row[0], row[1]
+    return None, None
+
+
+@_dispatch
+def store_feed_validators(url: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+    _write(
+        lambda conn: conn.execute(
+            """
+            INSERT INTO feed_validators (url, etag, last_modified)
+            VALUES (?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                etag = excluded.etag,
+                last_modified = excluded.last_modified
+            """,
+            (url, etag, last_modified),
+        )
+    )
+
+
+@_dispatch
+def get_feed_watermark(url: str) -> Tuple[Optional[str], Optional[float]]:
+    """Return the ``(last_guid, last_published)`` high-water mark for a feed."""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT last_guid, last_published FROM feed_watermarks WHERE url = ?",
+        (url,),
+    ).fetchone()
+    if row:
+        return row[0], row[1]
+    return None, None
+
+
+@_dispatch
+def store_feed_watermark(url: str, last_guid: Optional[str], last_published: Optional[float]) -> None:
+    _write(
+        lambda conn: conn.execute(
+            """
+            INSERT INTO feed_watermarks (url, last_guid, last_published, updated_at)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT(url) DO UPDATE SET
+                last_guid = excluded.last_guid,
+                last_published = excluded.last_published,
+                updated_at = excluded.updated_at
+            """,
+            (url, last_guid, last_published),
+        )
+    )
+
+
+@_dispatch
+def get_feed_schedules() -> Dict[str, Dict[str, Optional[float]]]:
+    """Return the polling schedule of every feed, keyed by URL."""
+    conn = get_conn()
+    cur = conn.execute(
+        "SELECT url, next_poll_at, interval, publish_interval, last_polled_at FROM feed_schedule"
+    )
+    return {
+        row[0]: {
+            "next_poll_at": row[1],
+            "interval": row[2],
+            "publish_interval": row[3],
+            "last_polled_at": row[4],
+        }
+        for row in cur.fetchall()
+    }
+
+
+@_dispatch
+def store_feed_schedule(
+    url: str,
+    next_poll_at: float,
+    interval: float,
+    publish_interval: Optional[float] = None,
+    last_polled_at: Optional[float] = None,
+) -> None:
+    _write(
+        lambda conn: conn.execute(
+            """
+            INSERT INTO feed_schedule (url, next_poll_at, interval, publish_interval, last_polled_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                next_poll_at = excluded.next_poll_at,
+                interval = excluded.interval,
+                publish_interval = excluded.publish_interval,
+                last_polled_at = excluded.last_polled_at
+            """,
+            (url, next_poll_at, interval, publish_interval, last_polled_at),
+        )
+    )
+
+
+JOB_PENDING = "pending"
+JOB_IN_PROGRESS = "in_progress"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def _find_near_duplicate(
+    conn: sqlite3.Connection, fingerprint: int, max_distance: int, since: float
+) -> Optional[Tuple[str, int]]:
+    """Return the closest indexed article within ``max_distance`` bits and its distance."""
+    buckets = simhash.buckets(fingerprint)
+    rows = conn.execute(
+        f"""
+        SELECT DISTINCT s.hash, s.simhash FROM article_simhash_buckets b
+        JOIN article_simhash s ON s.hash = b.hash
+        WHERE b.bucket IN ({','.join('?' for _ in buckets)}) AND s.created_at >= ?
         """,
-        (url, int(success), reason),
+        (*buckets, since),
+    ).fetchall()
+    return simhash.closest(fingerprint, rows, max_distance)
+
+
+@_dispatch
+def enqueue_rewrite_jobs(
+    articles: List[Dict[str, Any]],
+    source: str = "",
+    duplicate_max_distance: int = -1,
+    duplicate_window: float = 30 * 24 * 3600,
+) -> List[bool]:
+    """Mark articles as processed and queue a rewrite job for each new one.
+
+    Both happen in one transaction, so an article is never marked processed
+    without a job that will rewrite it. With ``duplicate_max_distance`` of 0
+    or more, a new article whose summary SimHash is that close to an article
+    indexed in the last ``duplicate_window`` seconds is linked to it in
+    ``article_duplicates`` instead of getting a job. Returns one flag per
+    article, ``False`` for those already seen.
+    """
+    if not articles:
+        return []
+    now = time.time()
+    payloads = [json.dumps(a) for a in articles]
+    fingerprints = [
+        simhash.simhash(a.get("summary", "")) if duplicate_max_distance >= 0 else None
+        for a in articles
+    ]
+
+    def op(conn: sqlite3.Connection) -> List[bool]:
+        flags = []
+        for article, payload, fingerprint in zip(articles, payloads, fingerprints):
+            new = _insert_processed(conn, article["title"], article["link"], article.get("date", ""))
+            flags.append(new)
+            if not new:
+                continue
+            article_hash = compute_hash(article["title"], article.get("date", ""))
+            if fingerprint is not None:
+                fingerprint = simhash.to_signed(fingerprint)
+                match = _find_near_duplicate(
+                    conn, fingerprint, duplicate_max_distance, now - duplicate_window
+                )
+                if match:
+                    conn.execute(
+                        """
+                        INSERT OR IGNORE INTO article_duplicates
+                            (hash, duplicate_of, link, source, distance, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (article_hash, match[0], article["link"], source, match[1], now),
+                    )
+                    NEAR_DUPLICATES.inc()
+                    continue
+                conn.execute(
+                    "INSERT OR IGNORE INTO article_simhash (hash, simhash, created_at) VALUES (?, ?, ?)",
+                    (article_hash, fingerprint, now),
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO article_simhash_buckets (bucket, hash) VALUES (?, ?)",
+                    [(bucket, article_hash) for bucket in simhash.buckets(fingerprint)],
+                )
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO rewrite_jobs (hash, source, article, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (article_hash, source, payload, JOB_PENDING, now, now),
+            )
+        return flags
+
+    return _write(op)
+
+
+@_dispatch
+def get_duplicate_of(article_hash: str) -> Optional[str]:
+    """Hash of the article whose rewrite ``article_hash`` was linked to, if any."""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT duplicate_of FROM article_duplicates WHERE hash = ?", (article_hash,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+@_dispatch
+def prune_article_simhashes(max_age: float) -> int:
+    """Drop SimHashes older than ``max_age`` seconds from the duplicate index."""
+    cutoff = time.time() - max_age
+
+    def op(conn: sqlite3.Connection) -> int:
+        conn.execute(
+            """
+            DELETE FROM article_simhash_buckets
+            WHERE hash IN (SELECT hash FROM article_simhash WHERE created_at < ?)
+            """,
+            (cutoff,),
+        )
+        return conn.execute("DELETE FROM article_simhash WHERE created_at < ?", (cutoff,)).rowcount
+
+    return _write(op)
+
+
+@_dispatch
+def claim_rewrite_jobs(
+    limit: int,
+    lease: float,
+    max_attempts: int,
+    hashes: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    """Lease up to ``limit`` runnable jobs for ``lease`` seconds.
+
+    Runnable are pending jobs whose retry delay has passed and in-progress
+    jobs whose lease expired because their worker crashed or hung. Expired
+    jobs that already used ``max_attempts`` are marked failed instead.
+    ``hashes`` restricts the claim to specific articles.
+    """
+    now = time.time()
+
+    def op(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+        conn.execute(
+            """
+            UPDATE rewrite_jobs SET status = ?, last_error = 'lease expired', updated_at = ?
+            WHERE status = ? AND lease_until < ? AND attempts >= ?
+            """,
+            (JOB_FAILED, now, JOB_IN_PROGRESS, now, max_attempts),
+        )
+        query = """
+            SELECT id, hash, source, article, attempts FROM rewrite_jobs
+            WHERE ((status = ? AND (lease_until IS NULL OR lease_until <= ?))
+               OR (status = ? AND lease_until < ?))
+        """
+        params: list = [JOB_PENDING, now, JOB_IN_PROGRESS, now]
+        if hashes is not None:
+            if not hashes:
+                return []
+            query += f" AND hash IN ({','.join('?' for _ in hashes)})"
+            params.extend(hashes)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        rows = conn.execute(query, params).fetchall()
+        conn.executemany(
+            """
+            UPDATE rewrite_jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            [(JOB_IN_PROGRESS, now + lease, now, row[0]) for row in rows],
+        )
+        return [
+            {
+                "id": row[0],
+                "hash": row[1],
+                "source": row[2],
+                "article": json.loads(row[3]),
+                "attempts": row[4] + 1,
+            }
+            for row in rows
+        ]
+
+    return _write(op)
+
+
+@_dispatch
+def complete_rewrite_jobs(results: List[Tuple[int, Dict[str, str]]]) -> int:
+    """Store the rewritten articles of finished jobs and mark them done.
+
+    ``results`` pairs job ids with the row to store. Everything is written in
+    one transaction; returns the number of articles inserted.
+    """
+    if not results:
+        return 0
+    rows = _rewritten_rows([row for _, row in results])
+    now = time.time()
+
+    def op(conn: sqlite3.Connection) -> int:
+        stored = _insert_rewritten(conn, rows)
+        conn.executemany(
+            "UPDATE rewrite_jobs SET status = ?, lease_until = NULL, last_error = NULL, updated_at = ? WHERE id = ?",
+            [(JOB_DONE, now, job_id) for job_id, _ in results],
+        )
+        return stored
+
+    stored = _write(op)
+    if stored:
+        events.publish()
+    return stored
+
+
+@_dispatch
+def fail_rewrite_job(job_id: int, error: str, max_attempts: int, retry_delay: float) -> bool:
+    """Return a job to the queue after a failed attempt.
+
+    The job becomes runnable again after ``retry_delay`` seconds, doubled for
+    every earlier attempt, or is marked failed once it has used
+    ``max_attempts``. Returns ``True`` if it will be retried.
+    """
+    now = time.time()
+
+    def op(conn: sqlite3.Connection) -> bool:
+        row = conn.execute("SELECT attempts FROM rewrite_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        attempts = row[0]
+        retry = attempts < max_attempts
+        conn.execute(
+            """
+            UPDATE rewrite_jobs SET status = ?, lease_until = ?, last_error = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (
+                JOB_PENDING if retry else JOB_FAILED,
+                now + backoff_delay(attempts, retry_delay, 24 * 3600) if retry else None,
+                error,
+                now,
+                job_id,
+            ),
+        )
+        return retry
+
+    return _write(op)
+
+
+@_dispatch
+def release_rewrite_jobs(job_ids: List[int], delay: float = 0.0) -> None:
+    """Put claimed jobs back without counting the attempt, runnable after ``delay`` seconds."""
+    if not job_ids:
+        return
+    now = time.time()
+    _write(
+        lambda conn: conn.executemany(
+            """
+            UPDATE rewrite_jobs
+            SET status = ?, attempts = MAX(attempts - 1, 0), lease_until = ?, updated_at = ?
+            WHERE id = ? AND status = ?
+            """,
+            [(JOB_PENDING, now + delay, now, job_id, JOB_IN_PROGRESS) for job_id in job_ids],
+        )
     )
-    conn.commit()
 
 
-def get_failed_feeds() -> List[str]:
+@_dispatch
+def prune_rewrite_jobs(max_age: float) -> int:
+    """Delete finished jobs older than ``max_age`` seconds; failed ones are kept."""
+    cutoff = time.time() - max_age
+
+    def op(conn: sqlite3.Connection) -> int:
+        before = conn.total_changes
+        conn.execute(
+            "DELETE FROM rewrite_jobs WHERE status = ? AND updated_at < ?", (JOB_DONE, cutoff)
+        )
+        return conn.total_changes - before
+
+    return _write(op)
+
+
+def compute_rewrite_key(summary: str, model_name: str, prompt_template: str) -> str:
+    """Key a rewrite by normalized article body, model and prompt.
+
+    The title is deliberately left out so that the same advisory syndicated
+    under different headlines maps to the same entry.
+    """
+    normalized = re.sub(r"\s+", " ", summary).strip().casefold()
+    raw = "\x1f".join((normalized, model_name, prompt_template))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@_dispatch
+def get_cached_rewrite(key: str) -> Optional[str]:
     conn = get_conn()
-    cur = conn.execute("SELECT url FROM feed_status WHERE success = 0")
-    return [row[0] for row in cur.fetchall()]
+    row = conn.execute("SELECT content FROM rewrite_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        REWRITE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+    REWRITE_CACHE_LOOKUPS.labels(result="hit").inc()
+    # Usage bookkeeping is not worth waiting for.
+    _writer.submit(
+        lambda conn: conn.execute(
+            "UPDATE rewrite_cache SET hits = hits + 1, last_used_at = ? WHERE key = ?",
+            (time.time(), key),
+        )
+    )
+    return row[0]
+
+
+@_dispatch
+def store_cached_rewrite(key: str, model_name: str, content: str) -> None:
+    now = time.time()
+    _write(
+        lambda conn: conn.execute(
+            """
+            INSERT INTO rewrite_cache (key, model, content, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                content = excluded.content,
+                last_used_at = excluded.last_used_at
+            """,
+            (key, model_name, content, now, now),
+        )
+    )
+
+
+@_dispatch
+def prune_rewrite_cache(max_entries: int, max_age: float) -> int:
+    """Drop entries unused for ``max_age`` seconds, then the least recently
+    used ones beyond ``max_entries``. Returns the number of rows removed."""
+
+    def op(conn: sqlite3.Connection) -> int:
+        before = conn.total_changes
+        conn.execute(
+            "DELETE FROM rewrite_cache WHERE last_used_at < ?",
+            (time.time() - max_age,),
+        )
+        conn.execute(
+            """
+            DELETE FROM rewrite_cache WHERE key IN (
+                SELECT key FROM rewrite_cache
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_entries,),
+        )
+        return conn.total_changes - before
+
+    return _write(op)
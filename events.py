@@ -0,0 +1,62 @@
+"""In-process notification of newly stored rewritten articles.
+
+:mod:`db` calls :func:`publish` after a transaction that inserted rewritten
+articles has committed, from whichever thread ran it. Each subscriber is an
+asyncio waiter bound to its event loop; notifications carry no payload and
+coalesce, so a subscriber that wakes up reads everything new from the
+database itself. Writes made by other processes (the feed manager, Celery
+workers) do not notify, which is why subscribers also poll.
+"""
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Set
+
+
+class Subscription:
+    """Wakes up when new articles are published."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._event = asyncio.Event()
+
+    def notify(self) -> None:
+        self._event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds; return whether anything was published."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+_subscribers: Set[Subscription] = set()
+_lock = threading.Lock()
+
+
+@contextmanager
+def subscribe() -> Iterator[Subscription]:
+    """Register a subscription on the running event loop for the block's duration."""
+    subscription = Subscription(asyncio.get_running_loop())
+    with _lock:
+        _subscribers.add(subscription)
+    try:
+        yield subscription
+    finally:
+        with _lock:
+            _subscribers.discard(subscription)
+
+
+def publish() -> None:
+    """Wake every subscriber; safe to call from any thread."""
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscription in subscribers:
+        try:
+            subscription.loop.call_soon_threadsafe(subscription.notify)
+        except RuntimeError:
+            # The subscriber's loop is closed; it unsubscribes on its way out.
+            pass
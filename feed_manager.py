@@ -1,29 +1,47 @@
 import argparse
 import asyncio
 import logging
+from collections import defaultdict
 from configparser import ConfigParser
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-from rss_parser import parse_rss, DEFAULT_LIMIT, validate_feed
+import httpx
+
+from rss_parser import DEFAULT_LIMIT, USER_AGENT, FeedFetchResult, fetch_feed_async
 from db import (
-    store_processed_article,
-    store_rewritten_article,
+    enqueue_rewrite_jobs,
+    claim_rewrite_jobs,
+    prune_article_simhashes,
+    prune_rewrite_jobs,
     record_feed_status,
-    get_failed_feeds,
+    get_backed_off_feeds,
+    get_feed_validators,
+    store_feed_validators,
+    prune_rewrite_cache,
+    compute_hash,
+    find_processed_hashes,
+    get_feed_watermark,
+    store_feed_watermark,
 )
 from llm_client import LLMClient, LLMConfig
+from rewriter import drain_rewrite_jobs, run_rewrite_jobs
+import settings
+from settings import read_config
+
 
+CONFIG_PATH = settings.CONFIG_PATH
 
-CONFIG_PATH = Path(__file__).resolve().parent / "config.ini"
 
+def load_feed_config(path: Path = CONFIG_PATH) -> Tuple[Tuple[str, ...], int]:
+    return parse_feed_config(read_config(path), path)
 
-def load_feed_config(path: Path = CONFIG_PATH) -> Tuple[List[str], int]:
-    parser = ConfigParser(interpolation=None)
-    read = parser.read(path)
-    if not read:
-        raise FileNotFoundError(f"Config file not found: {path}")
 
+def parse_feed_config(parser: ConfigParser, path: Path = CONFIG_PATH) -> Tuple[Tuple[str, ...], int]:
+    """Return the feed URLs and the fetch interval of the ``[RSS]`` section."""
     feeds: List[str] = []
     if parser.has_option("RSS", "feeds"):
         raw = parser.get("RSS", "feeds")
@@ -34,71 +52,331 @@ def load_feed_config(path: Path = CONFIG_PATH) -> Tuple[List[str], int]:
                     feeds.append(url)
 
     interval = parser.getint("RSS", "interval", fallback=3600)
-    return feeds, interval
+    return tuple(feeds), interval
 
 
-async def rewrite_and_store(
-    article: dict, llm: LLMClient, source: str, prompt_template: str
-) -> None:
-    try:
-        if not store_processed_article(article["title"], article["link"], article.get("date", "")):
-            logging.debug("Duplicate article skipped from %s: %s", source, article["title"])
-            return
-
-        prompt = prompt_template.format(title=article["title"], summary=article["summary"])
-        rewritten = await asyncio.to_thread(llm.generate, prompt)
-        store_rewritten_article(article["title"], article["link"], rewritten, article.get("date", ""))
-        logging.info("Stored rewritten article from %s: %s", source, article["title"])
-    except Exception as exc:
-        logging.error("Failed to rewrite %s from %s: %s", article.get("title"), source, exc)
+@dataclass(frozen=True)
+class FetchConfig:
+    max_concurrency: int = 10
+    per_host_concurrency: int = 2
+    connect_timeout: float = 5.0
+    read_timeout: float = 20.0
+    total_timeout: float = 60.0
+    max_new_entries: int = 20
+    backfill: int = DEFAULT_LIMIT
+    failure_backoff: float = 300.0
+    max_failure_backoff: float = 86400.0
+
+    @classmethod
+    def load(cls, path: Path = CONFIG_PATH, section: str = "RSS") -> "FetchConfig":
+        return cls.from_parser(read_config(path), path, section)
+
+    @classmethod
+    def from_parser(
+        cls, parser: ConfigParser, path: Path = CONFIG_PATH, section: str = "RSS"
+    ) -> "FetchConfig":
+        return cls(
+            max_concurrency=parser.getint(section, "max_concurrency", fallback=cls.max_concurrency),
+            per_host_concurrency=parser.getint(
+                section, "per_host_concurrency", fallback=cls.per_host_concurrency
+            ),
+            connect_timeout=parser.getfloat(section, "connect_timeout", fallback=cls.connect_timeout),
+            read_timeout=parser.getfloat(section, "read_timeout", fallback=cls.read_timeout),
+            total_timeout=parser.getfloat(section, "total_timeout", fallback=cls.total_timeout),
+            max_new_entries=parser.getint(section, "max_new_entries", fallback=cls.max_new_entries),
+            backfill=parser.getint(section, "backfill", fallback=cls.backfill),
+            failure_backoff=parser.getfloat(
+                section, "failure_backoff", fallback=cls.failure_backoff
+            ),
+            max_failure_backoff=parser.getfloat(
+                section, "max_failure_backoff", fallback=cls.max_failure_backoff
+            ),
+        )
+
+
+def build_http_client(config: FetchConfig) -> httpx.AsyncClient:
+    """Create the keep-alive client shared by every feed in a cycle."""
+    timeout = httpx.Timeout(
+        config.read_timeout,
+        connect=config.connect_timeout,
+        pool=config.total_timeout,
+    )
+    limits = httpx.Limits(
+        max_connections=config.max_concurrency,
+        max_keepalive_connections=config.max_concurrency,
+    )
+    return httpx.AsyncClient(
+        timeout=timeout,
+        limits=limits,
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+
+class HostLimiter:
+    """Caps in-flight requests globally and per host."""
+
+    def __init__(self, max_concurrency: int, per_host: int):
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._per_host = per_host
+        self._hosts: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self._per_host)
+        )
+
+    @asynccontextmanager
+    async def limit(self, url: str) -> AsyncIterator[None]:
+        host = urlparse(url).netloc.lower()
+        async with self._hosts[host], self._global:
+            yield
+
+
+def newest_first(articles: List[dict]) -> List[dict]:
+    """Order entries newest first by their published time.
+
+    Most feeds already list their newest entries first, but some list them
+    oldest first or by update time. Entries are only reordered when every
+    one of them has a timestamp; otherwise the feed's own order is kept.
+    """
+    if all(a.get("published_ts") is not None for a in articles):
+        return sorted(articles, key=lambda a: a["published_ts"], reverse=True)
+    return list(articles)
+
+
+def select_new_entries(
+    articles: List[dict],
+    last_guid: Optional[str],
+    last_published: Optional[float],
+    fetch_config: FetchConfig,
+) -> Tuple[List[dict], int]:
+    """Return the entries published after the feed's high-water mark.
+
+    Entries are taken in :func:`newest_first` order, so scanning stops at the
+    last GUID seen. Entries with a timestamp at or before the last published
+    time are skipped as well. A feed without a mark only yields its newest
+    ``backfill`` entries. Beyond ``max_new_entries`` the oldest new entries
+    are taken, and the number left for the next poll is returned alongside
+    them.
+    """
+    articles = newest_first(articles)
+    if last_guid is None and last_published is None:
+        return articles[:fetch_config.backfill], 0
+    new: List[dict] = []
+    for article in articles:
+        if article.get("guid") == last_guid:
+            break
+        published = article.get("published_ts")
+        if last_published is not None and published is not None and published <= last_published:
+            continue
+        new.append(article)
+    deferred = max(0, len(new) - fetch_config.max_new_entries)
+    return new[deferred:], deferred
+
+
+def next_watermark(
+    articles: List[dict], last_published: Optional[float]
+) -> Tuple[Optional[str], Optional[float]]:
+    """Return the GUID of the newest entry and the latest published time."""
+    stamps = [a["published_ts"] for a in articles if a.get("published_ts") is not None]
+    if last_published is not None:
+        stamps.append(last_published)
+    return newest_first(articles)[0].get("guid"), max(stamps) if stamps else None
+
 
+class CeleryDispatcher:
+    """Hands queued rewrite jobs to the Celery worker in batches.
 
-async def fetch_and_store(url: str) -> None:
-    ok, reason, data = await asyncio.to_thread(validate_feed, url)
-    record_feed_status(url, ok, reason)
-    if not ok:
-        logging.error("Skipping %s: %s", url, reason)
-        return
+    The jobs are already stored in the database when they are sent, so a
+    lost message only delays them until the next drain.
+    """
+
+    def __init__(self, batch_size: int):
+        from worker.worker.tasks import drain_rewrite_jobs as drain_task
+        from worker.worker.tasks import rewrite_articles_batch
+
+        self._batch_task = rewrite_articles_batch
+        self._drain_task = drain_task
+        self.batch_size = batch_size
+
+    def send(self, articles: List[dict], source: str) -> None:
+        for start in range(0, len(articles), self.batch_size):
+            self._batch_task.delay(articles[start:start + self.batch_size], source)
+
+    def drain(self) -> None:
+        self._drain_task.delay()
+
+
+async def fetch_and_store(
+    url: str,
+    http: httpx.AsyncClient,
+    limiter: HostLimiter,
+    llm: LLMClient,
+    fetch_config: FetchConfig,
+    dispatcher: Optional[CeleryDispatcher] = None,
+) -> FeedFetchResult:
+    """Fetch one feed and rewrite and store its new entries.
+
+    With a ``dispatcher`` the new entries are sent to the Celery worker
+    instead of being rewritten here. Returns the fetch result so that
+    callers can schedule the next poll.
+    """
+    etag, last_modified = await asyncio.to_thread(get_feed_validators, url)
     try:
-        articles = await asyncio.to_thread(parse_rss, url, DEFAULT_LIMIT, data)
-        if len(articles) < DEFAULT_LIMIT:
-            logging.warning("%s returned %d articles", url, len(articles))
+        async with limiter.limit(url):
+            result = await asyncio.wait_for(
+                fetch_feed_async(http, url, None, etag, last_modified),
+                timeout=fetch_config.total_timeout,
+            )
+    except asyncio.TimeoutError:
+        result = FeedFetchResult(False, f"Timed out after {fetch_config.total_timeout}s")
+    delay = await asyncio.to_thread(
+        record_feed_status,
+        url,
+        result.ok,
+        result.reason,
+        result.retry_after,
+        fetch_config.failure_backoff,
+        fetch_config.max_failure_backoff,
+    )
+    if not result.ok:
+        # From here on retry_after is the feed's backoff, which already
+        # includes any Retry-After the server sent.
+        result.retry_after = delay
+        logging.error("Skipping %s: %s (retrying in %.0f seconds)", url, result.reason, delay)
+        return result
+    if result.not_modified:
+        logging.info("%s not modified since last fetch", url)
+        return result
+    try:
+        articles = result.articles
+        last_guid, last_published = await asyncio.to_thread(get_feed_watermark, url)
+        candidates, deferred = select_new_entries(articles, last_guid, last_published, fetch_config)
+        taken = candidates
+        seen = await asyncio.to_thread(
+            find_processed_hashes,
+            [compute_hash(a["title"], a.get("date", "")) for a in candidates],
+        )
+        candidates = [
+            a for a in candidates if compute_hash(a["title"], a.get("date", "")) not in seen
+        ]
+        logging.info(
+            "Fetched %d entries from %s, %d new", len(articles), url, len(candidates)
+        )
+
+        # New entries become durable rewrite jobs first, so a failed or
+        # interrupted rewrite is retried later instead of being lost.
+        fresh = []
+        if candidates:
+            is_new = await asyncio.to_thread(
+                enqueue_rewrite_jobs,
+                candidates,
+                url,
+                llm.config.duplicate_max_distance,
+                llm.config.duplicate_window,
+            )
+            fresh = [art for art, new in zip(candidates, is_new) if new]
+        if fresh and dispatcher is not None:
+            try:
+                await asyncio.to_thread(dispatcher.send, fresh, url)
+                logging.info("Sent %d articles from %s to the worker", len(fresh), url)
+            except Exception as exc:
+                logging.error("Failed to dispatch %s, leaving its jobs queued: %s", url, exc)
+            fresh = []
+        jobs = []
+        if fresh:
+            config = llm.config
+            jobs = await asyncio.to_thread(
+                claim_rewrite_jobs,
+                len(fresh),
+                config.job_lease,
+                config.job_max_attempts,
+                [compute_hash(a["title"], a.get("date", "")) for a in fresh],
+            )
+        stored = await run_rewrite_jobs(jobs, llm)
+        if stored:
+            logging.info("Stored %d rewritten articles from %s", stored, url)
+        # Only advance the mark and the validators once the entries have been
+        # handled so that a failed cycle is retried with a full fetch next time.
+        if deferred:
+            # Stop at the newest entry taken and force a full fetch, so the
+            # next poll picks up the rest.
+            logging.info(
+                "Deferring %d new entries of %s to the next poll (max_new_entries)", deferred, url
+            )
+            guid, published = next_watermark(taken, last_published)
+            await asyncio.to_thread(store_feed_watermark, url, guid, published)
+            await asyncio.to_thread(store_feed_validators, url, None, None)
         else:
-            logging.info("Fetched %d articles from %s", len(articles), url)
-
-        config = LLMConfig.load()
-        with LLMClient(config) as llm:
-            tasks = [
-                rewrite_and_store(art, llm, url, config.rewrite_prompt)
-                for art in articles
-            ]
-            if tasks:
-                await asyncio.gather(*tasks)
+            guid, published = next_watermark(articles, last_published)
+            await asyncio.to_thread(store_feed_watermark, url, guid, published)
+            await asyncio.to_thread(store_feed_validators, url, result.etag, result.last_modified)
     except Exception as exc:
         logging.error("Failed to process %s: %s", url, exc)
+    return result
+
+
+async def run_cycle(
+    feeds: List[str],
+    fetch_config: FetchConfig,
+    config: Optional[LLMConfig] = None,
+    dispatcher: Optional[CeleryDispatcher] = None,
+) -> None:
+    """Process one round of feeds over a single pooled HTTP and LLM client."""
+    limiter = HostLimiter(fetch_config.max_concurrency, fetch_config.per_host_concurrency)
+    config = config or settings.get(LLMConfig.from_parser)
+    async with build_http_client(fetch_config) as http, LLMClient(config) as llm:
+        tasks = [
+            fetch_and_store(url, http, limiter, llm, fetch_config, dispatcher) for url in feeds
+        ]
+        if tasks:
+            await asyncio.gather(*tasks)
+        if dispatcher is not None:
+            await asyncio.to_thread(dispatcher.drain)
+        else:
+            retried = await drain_rewrite_jobs(llm)
+            if retried:
+                logging.info("Stored %d rewritten articles from queued jobs", retried)
+    await asyncio.to_thread(prune_rewrite_jobs, config.job_retention)
+    await asyncio.to_thread(prune_article_simhashes, config.duplicate_window)
+    pruned = await asyncio.to_thread(
+        prune_rewrite_cache, config.rewrite_cache_max_entries, config.rewrite_cache_max_age
+    )
+    if pruned:
+        logging.info("Pruned %d rewrite cache entries", pruned)
 
 
-async def run_async(config_path: Path = CONFIG_PATH, loop: bool = False) -> None:
+async def run_async(
+    config_path: Path = CONFIG_PATH, loop: bool = False, celery: bool = False
+) -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
     logging.info("Feed manager started")
+    settings.reload_on_sighup()
+    dispatcher = None
+    if celery:
+        dispatcher = CeleryDispatcher(settings.get(LLMConfig.from_parser, config_path).job_batch_size)
     while True:
-        feeds, interval = load_feed_config(config_path)
+        # Picks up edits to config.ini between cycles.
+        config = settings.snapshot(config_path)
+        feeds, interval = config.get(parse_feed_config)
+        fetch_config = config.get(FetchConfig.from_parser)
         if not feeds:
             logging.warning("No feeds configured")
-        failed = set(get_failed_feeds())
+        failed = set(get_backed_off_feeds())
         if failed:
-            logging.info("Skipping %d failed feeds", len(failed))
-        tasks = [fetch_and_store(url) for url in feeds if url not in failed]
-        if tasks:
-            await asyncio.gather(*tasks)
+            logging.info("Skipping %d failing feeds until their backoff expires", len(failed))
+        await run_cycle(
+            [url for url in feeds if url not in failed],
+            fetch_config,
+            config.get(LLMConfig.from_parser),
+            dispatcher,
+        )
         if not loop:
             break
         logging.info("Waiting %s seconds before next fetch", interval)
         await asyncio.sleep(interval)
 
 
-def run(config_path: Path = CONFIG_PATH, loop: bool = False) -> None:
-    asyncio.run(run_async(config_path, loop))
+def run(config_path: Path = CONFIG_PATH, loop: bool = False, celery: bool = False) -> None:
+    asyncio.run(run_async(config_path, loop, celery))
 
 
 if __name__ == "__main__":
@@ -111,5 +389,19 @@ if __name__ == "__main__":
         action="store_true",
         help="Run continuously using the interval from the config file",
     )
+    parser.add_argument(
+        "--celery",
+        action="store_true",
+        help="Send new articles to the Celery worker instead of rewriting them here",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port while running",
+    )
     args = parser.parse_args()
-    run(args.config, loop=args.loop)
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+
+        start_http_server(args.metrics_port)
+    run(args.config, loop=args.loop, celery=args.celery)
@@ -0,0 +1,87 @@
+"""Conditional requests and content encoding for the read endpoints.
+
+Responses are validated with a weak ``ETag`` derived from the version of the
+stored articles (see :func:`db.get_articles_version`) and with
+``Last-Modified``. Bodies are compressed with brotli or gzip, whichever the
+client prefers, and only when that saves something worthwhile.
+"""
+import gzip
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+
+import brotli
+
+BROTLI = "br"
+GZIP = "gzip"
+IDENTITY = "identity"
+# Preferred first when a client accepts several with the same quality
+ENCODINGS = (BROTLI, GZIP)
+# Smaller bodies are sent uncompressed
+MIN_COMPRESS_SIZE = 512
+# Bodies are compressed once per version, so favour ratio over speed.
+BROTLI_QUALITY = 6
+GZIP_LEVEL = 6
+
+
+def etag(version: int) -> str:
+    return f'W/"{version}"'
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def _etag_matches(header: str, tag: str) -> bool:
+    # If-None-Match uses weak comparison.
+    candidates = [c.strip() for c in header.split(",")]
+    return "*" in candidates or any(c.removeprefix("W/") == tag.removeprefix("W/") for c in candidates)
+
+
+def not_modified(headers: Mapping[str, str], tag: str, modified: float) -> bool:
+    """Whether the conditional headers show the client's copy is current."""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        # Takes precedence over If-Modified-Since (RFC 9110, 13.2.2).
+        return _etag_matches(if_none_match, tag)
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole seconds.
+        return int(modified) <= since
+    return False
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> str:
+    """Pick the encoding to use for a request's ``Accept-Encoding``."""
+    if not accept_encoding:
+        return IDENTITY
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip().lower()] = quality
+    default = weights.get("*", 0.0)
+    best, best_quality = IDENTITY, 0.0
+    for encoding in ENCODINGS:
+        quality = weights.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == GZIP:
+        # A fixed mtime keeps the output, and so the cached bytes, stable.
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
@@ -1,24 +1,61 @@
+import asyncio
 import json
 import logging
 import re
 import time
-from configparser import ConfigParser
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, List
+from configparser import ConfigParser
+from typing import AsyncIterator, Optional, List, Tuple
 
+import httpx
 import requests
-from tenacity import Retrying, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    stop_after_attempt,
+    wait_exponential,
+    retry_if_exception_type,
+)
+
+from llm_pool import LEAST_OUTSTANDING, ROUTING, EndpointPool, LLMEndpoint, parse_endpoints
+from metrics import LLM_RETRIES, TokenTimer
+from settings import read_config
 
 logger = logging.getLogger(__name__)
 DEFAULT_CONFIG_PATH = Path(__file__).resolve().parent / "config.ini"
 
-@dataclass
+@dataclass(frozen=True)
 class LLMConfig:
     api_url: str
     model_name: str
     timeout: int = 60
     max_retries: int = 3
+    rewrite_cache_max_entries: int = 10000
+    rewrite_cache_max_age: int = 30 * 24 * 3600
+    max_in_flight: int = 2
+    interactive_queue_depth: int = 32
+    background_queue_depth: int = 1000
+    interactive_deadline: float = 180.0
+    background_deadline: float = 1800.0
+    breaker_failure_threshold: int = 5
+    breaker_backoff: float = 30.0
+    breaker_max_backoff: float = 600.0
+    job_batch_size: int = 20
+    job_lease: float = 3600.0
+    job_max_attempts: int = 5
+    job_retry_delay: float = 60.0
+    job_retention: float = 7 * 24 * 3600
+    duplicate_max_distance: int = 6
+    duplicate_window: float = 30 * 24 * 3600
+    max_input_tokens: int = 1024
+    # (model, tokens) pairs overriding max_input_tokens
+    model_input_tokens: Tuple[Tuple[str, int], ...] = ()
+    batch_max_articles: int = 0
+    batch_max_tokens: int = 2048
+    endpoints: Tuple[LLMEndpoint, ...] = ()
+    routing: str = LEAST_OUTSTANDING
+    slow_first_token: float = 0.0
     rewrite_prompt: str = (
         "Rewrite the following article in your own words:\n\nTitle: {title}\n\n{summary}"
     )
@@ -26,33 +63,162 @@ class LLMConfig:
     @classmethod
     def load(cls, path: Optional[Path] = None, section: str = "LLM") -> "LLMConfig":
         cfg_path = path or DEFAULT_CONFIG_PATH
-        parser = ConfigParser(interpolation=None)
-        read = parser.read(cfg_path)
-        if not read:
-            raise FileNotFoundError(f"Config file not found: {cfg_path}")
+        return cls.from_parser(read_config(cfg_path), cfg_path, section)
+
+    @classmethod
+    def from_parser(
+        cls, parser: ConfigParser, cfg_path: Path = DEFAULT_CONFIG_PATH, section: str = "LLM"
+    ) -> "LLMConfig":
         api_url = parser.get(section, "api_url", fallback=None)
         model_name = parser.get(section, "model_name", fallback=None)
         timeout = parser.getint(section, "timeout", fallback=60)
         max_retries = parser.getint(section, "max_retries", fallback=3)
+        cache_entries = parser.getint(
+            section, "rewrite_cache_max_entries", fallback=cls.rewrite_cache_max_entries
+        )
+        cache_age = parser.getint(
+            section, "rewrite_cache_max_age", fallback=cls.rewrite_cache_max_age
+        )
+        max_in_flight = parser.getint(section, "max_in_flight", fallback=cls.max_in_flight)
+        interactive_depth = parser.getint(
+            section, "interactive_queue_depth", fallback=cls.interactive_queue_depth
+        )
+        background_depth = parser.getint(
+            section, "background_queue_depth", fallback=cls.background_queue_depth
+        )
+        interactive_deadline = parser.getfloat(
+            section, "interactive_deadline", fallback=cls.interactive_deadline
+        )
+        background_deadline = parser.getfloat(
+            section, "background_deadline", fallback=cls.background_deadline
+        )
+        breaker_threshold = parser.getint(
+            section, "breaker_failure_threshold", fallback=cls.breaker_failure_threshold
+        )
+        breaker_backoff = parser.getfloat(section, "breaker_backoff", fallback=cls.breaker_backoff)
+        breaker_max_backoff = parser.getfloat(
+            section, "breaker_max_backoff", fallback=cls.breaker_max_backoff
+        )
+        job_batch_size = parser.getint(section, "job_batch_size", fallback=cls.job_batch_size)
+        job_lease = parser.getfloat(section, "job_lease", fallback=cls.job_lease)
+        job_max_attempts = parser.getint(section, "job_max_attempts", fallback=cls.job_max_attempts)
+        job_retry_delay = parser.getfloat(section, "job_retry_delay", fallback=cls.job_retry_delay)
+        job_retention = parser.getfloat(section, "job_retention", fallback=cls.job_retention)
+        duplicate_max_distance = parser.getint(
+            section, "duplicate_max_distance", fallback=cls.duplicate_max_distance
+        )
+        duplicate_window = parser.getfloat(section, "duplicate_window", fallback=cls.duplicate_window)
+        max_input_tokens = parser.getint(section, "max_input_tokens", fallback=cls.max_input_tokens)
+        model_input_tokens = _parse_model_budgets(parser.get(section, "model_input_tokens", fallback=""))
+        batch_max_articles = parser.getint(
+            section, "batch_max_articles", fallback=cls.batch_max_articles
+        )
+        batch_max_tokens = parser.getint(section, "batch_max_tokens", fallback=cls.batch_max_tokens)
+        try:
+            endpoints = tuple(parse_endpoints(parser.get(section, "endpoints", fallback="")))
+        except ValueError as exc:
+            raise ValueError(f"Invalid 'endpoints' in [{section}] of {cfg_path}: {exc}") from exc
+        routing = parser.get(section, "routing", fallback=cls.routing).strip()
+        slow_first_token = parser.getfloat(section, "slow_first_token", fallback=cls.slow_first_token)
         rewrite_prompt = parser.get(
             section,
             "rewrite_prompt",
             fallback="Rewrite the following article in your own words:\n\nTitle: {title}\n\n{summary}",
         )
+        if endpoints and not api_url:
+            api_url = endpoints[0].url
         if not api_url or not model_name:
             raise ValueError(f"Both 'api_url' and 'model_name' must be set in [{section}] of {cfg_path}")
+        if routing not in ROUTING:
+            raise ValueError(
+                f"Unknown routing '{routing}' in [{section}] of {cfg_path}, expected one of {ROUTING}"
+            )
+        if any(e.weight <= 0 for e in endpoints):
+            raise ValueError(f"Endpoint weights must be positive in [{section}] of {cfg_path}")
+        if endpoints and not any(e.serves(model_name) for e in endpoints):
+            raise ValueError(f"No endpoint in [{section}] of {cfg_path} serves model '{model_name}'")
         return cls(
             api_url=api_url,
             model_name=model_name,
             timeout=timeout,
             max_retries=max_retries,
+            rewrite_cache_max_entries=cache_entries,
+            rewrite_cache_max_age=cache_age,
+            max_in_flight=max_in_flight,
+            interactive_queue_depth=interactive_depth,
+            background_queue_depth=background_depth,
+            interactive_deadline=interactive_deadline,
+            background_deadline=background_deadline,
+            breaker_failure_threshold=breaker_threshold,
+            breaker_backoff=breaker_backoff,
+            breaker_max_backoff=breaker_max_backoff,
+            job_batch_size=job_batch_size,
+            job_lease=job_lease,
+            job_max_attempts=job_max_attempts,
+            job_retry_delay=job_retry_delay,
+            job_retention=job_retention,
+            duplicate_max_distance=duplicate_max_distance,
+            duplicate_window=duplicate_window,
+            max_input_tokens=max_input_tokens,
+            model_input_tokens=model_input_tokens,
+            batch_max_articles=batch_max_articles,
+            batch_max_tokens=batch_max_tokens,
+            endpoints=endpoints,
+            routing=routing,
+            slow_first_token=slow_first_token,
             rewrite_prompt=rewrite_prompt,
         )
 
+    def endpoint_list(self) -> List[LLMEndpoint]:
+        """The configured endpoints, or just ``api_url`` if none are listed."""
+        return list(self.endpoints) or [LLMEndpoint(self.api_url)]
+
+    def input_budget(self) -> int:
+        """Token budget for the article summary in a prompt to ``model_name``; 0 means unlimited."""
+        return dict(self.model_input_tokens).get(self.model_name, self.max_input_tokens)
+
+
+def _parse_model_budgets(raw: str) -> Tuple[Tuple[str, int], ...]:
+    """Parse ``model = tokens`` lines; the model name may itself contain colons."""
+    budgets = {}
+    for line in raw.splitlines():
+        model, sep, tokens = line.rpartition("=")
+        if sep and model.strip():
+            budgets[model.strip()] = int(tokens)
+    return tuple(budgets.items())
+
+
+def _is_endpoint_failure(exc: BaseException) -> bool:
+    """Whether ``exc`` says the endpoint itself is unhealthy.
+
+    Connection errors, timeouts, 5xx and 429 count; other client errors are
+    the caller's problem and do not trip the breaker.
+    """
+    if isinstance(exc, (requests.HTTPError, httpx.HTTPStatusError)):
+        status = exc.response.status_code if exc.response is not None else 500
+        return status >= 500 or status == 429
+    return isinstance(exc, (requests.RequestException, httpx.TransportError))
+
+
 class LLMClient:
-    def __init__(self, config: LLMConfig, session: Optional[requests.Session] = None):
+    def __init__(
+        self,
+        config: LLMConfig,
+        session: Optional[requests.Session] = None,
+        async_client: Optional[httpx.AsyncClient] = None,
+    ):
         self.config = config
+        self.pool = EndpointPool(
+            config.endpoint_list(),
+            config.routing,
+            config.breaker_failure_threshold,
+            config.breaker_backoff,
+            config.breaker_max_backoff,
+            config.slow_first_token,
+        )
         self.session = session or requests.Session()
+        self._async_client = async_client
+        self._owns_async_client = async_client is None
 
     def __enter__(self) -> "LLMClient":
         return self
@@ -60,38 +226,144 @@ class LLMClient:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.session.close()
 
-    def _send_request(self, payload: dict) -> str:
+    async def __aenter__(self) -> "LLMClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        self.session.close()
+        if self._async_client is not None and self._owns_async_client:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def available(self) -> bool:
+        """Whether any endpoint serving the model would take a request now."""
+        return self.pool.available(self.config.model_name)
+
+    def _record(self, endpoint: LLMEndpoint, timer: TokenTimer, exc: Optional[BaseException]) -> None:
+        if exc is None:
+            self.pool.record_success(endpoint, timer)
+        elif _is_endpoint_failure(exc):
+            self.pool.breaker(endpoint).record_failure()
+        else:
+            self.pool.breaker(endpoint).release()
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=self.config.timeout)
+        return self._async_client
+
+    def _send_request(self, payload: dict, endpoint: LLMEndpoint) -> str:
+        self.pool.breaker(endpoint).check()
         tokens: List[str] = []
-        with self.session.post(
-            self.config.api_url,
-            json=payload,
-            stream=True,
-            timeout=self.config.timeout,
-        ) as resp:
-            resp.raise_for_status()
-            for raw in resp.iter_lines(decode_unicode=True):
-                if not raw:
-                    continue
-                try:
-                    obj = json.loads(raw)
-                    tokens.append(obj.get("response", ""))
-                except json.JSONDecodeError:
-                    tokens.append(raw)
+        timer = TokenTimer(self.config.model_name)
+        outcome = "error"
+        failure: Optional[BaseException] = None
+        try:
+            with self.pool.outstanding(endpoint), self.session.post(
+                endpoint.url,
+                json=payload,
+                stream=True,
+                timeout=self.config.timeout,
+            ) as resp:
+                resp.raise_for_status()
+                for raw in resp.iter_lines(decode_unicode=True):
+                    if not raw:
+                        continue
+                    timer.token()
+                    try:
+                        obj = json.loads(raw)
+                        tokens.append(obj.get("response", ""))
+                    except json.JSONDecodeError:
+                        tokens.append(raw)
+            outcome = "ok"
+        except BaseException as exc:
+            failure = exc
+            raise
+        finally:
+            timer.finish(outcome)
+            self._record(endpoint, timer, failure)
         return "".join(tokens)
 
-    def _clean_output(self, text: str) -> str:
+    async def _astream_tokens(self, payload: dict, endpoint: LLMEndpoint) -> AsyncIterator[str]:
+        self.pool.breaker(endpoint).check()
+        timer = TokenTimer(self.config.model_name)
+        outcome = "error"
+        failure: Optional[BaseException] = None
+        try:
+            with self.pool.outstanding(endpoint):
+                async with self.async_client.stream(
+                    "POST",
+                    endpoint.url,
+                    json=payload,
+                    timeout=self.config.timeout,
+                ) as resp:
+                    resp.raise_for_status()
+                    async for raw in resp.aiter_lines():
+                        if not raw:
+                            continue
+                        timer.token()
+                        try:
+                            obj = json.loads(raw)
+                            yield obj.get("response", "")
+                        except json.JSONDecodeError:
+                            yield raw
+            outcome = "ok"
+        except (GeneratorExit, asyncio.CancelledError) as exc:
+            outcome = "cancelled"
+            failure = exc
+            raise
+        except BaseException as exc:
+            failure = exc
+            raise
+        finally:
+            timer.finish(outcome)
+            self._record(endpoint, timer, failure)
+
+    async def _asend_request(self, payload: dict, endpoint: LLMEndpoint) -> str:
+        return "".join([token async for token in self._astream_tokens(payload, endpoint)])
+
+    def _count_retry(self, retry_state) -> None:
+        LLM_RETRIES.labels(model=self.config.model_name).inc()
+
+    def _retry_wait(self, tried: set):
+        """Retry at once on another endpoint, or back off if none is left."""
+        backoff = wait_exponential(multiplier=1, min=1, max=10)
+
+        def wait(retry_state) -> float:
+            if self.pool.has_alternative(self.config.model_name, tried):
+                return 0.0
+            return backoff(retry_state)
+
+        return wait
+
+    def _next_endpoint(self, tried: set) -> LLMEndpoint:
+        # Each retry fails over to an endpoint this request has not tried yet.
+        endpoint = self.pool.choose(self.config.model_name, tried)
+        tried.add(endpoint.url)
+        return endpoint
+
+    def clean_output(self, text: str) -> str:
         return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
 
-    def generate(self, prompt: str, temperature: float = 0.6, strip_tags: bool = True) -> str:
-        payload = {
+    def _payload(self, prompt: str, temperature: float) -> dict:
+        return {
             "model": self.config.model_name,
             "prompt": prompt,
             "temperature": temperature,
         }
+
+    def generate(self, prompt: str, temperature: float = 0.6, strip_tags: bool = True) -> str:
+        payload = self._payload(prompt, temperature)
+        tried: set = set()
         retryer = Retrying(
             retry=retry_if_exception_type(requests.RequestException),
             stop=stop_after_attempt(self.config.max_retries),
-            wait=wait_exponential(multiplier=1, min=1, max=10),
+            wait=self._retry_wait(tried),
+            before_sleep=self._count_retry,
             reraise=True,
         )
 
@@ -100,8 +372,52 @@ class LLMClient:
             for attempt in retryer:
                 with attempt:
                     logger.debug("Sending prompt to model: %s", prompt)
-                    raw = self._send_request(payload)
-                    return self._clean_output(raw) if strip_tags else raw
+                    raw = self._send_request(payload, self._next_endpoint(tried))
+                    return self.clean_output(raw) if strip_tags else raw
+        finally:
+            duration = time.perf_counter() - start
+            logger.info("LLM request completed in %.2f seconds", duration)
+
+
+    async def agenerate(
+        self, prompt: str, temperature: float = 0.6, strip_tags: bool = True
+    ) -> str:
+        """Async variant of :meth:`generate` on the pooled ``httpx`` client."""
+        payload = self._payload(prompt, temperature)
+        tried: set = set()
+        retryer = AsyncRetrying(
+            retry=retry_if_exception_type(httpx.HTTPError),
+            stop=stop_after_attempt(self.config.max_retries),
+            wait=self._retry_wait(tried),
+            before_sleep=self._count_retry,
+            reraise=True,
+        )
+
+        start = time.perf_counter()
+        try:
+            async for attempt in retryer:
+                with attempt:
+                    logger.debug("Sending prompt to model: %s", prompt)
+                    raw = await self._asend_request(payload, self._next_endpoint(tried))
+                    return self.clean_output(raw) if strip_tags else raw
+        finally:
+            duration = time.perf_counter() - start
+            logger.info("LLM request completed in %.2f seconds", duration)
+
+    async def astream(self, prompt: str, temperature: float = 0.6) -> AsyncIterator[str]:
+        """Yield raw response tokens as the model produces them.
+
+        Unlike :meth:`agenerate` this is not retried, since tokens may already
+        have been consumed, and ``<think>`` blocks are not stripped; pass the
+        joined text to :meth:`clean_output` for that.
+        """
+        payload = self._payload(prompt, temperature)
+        logger.debug("Streaming prompt to model: %s", prompt)
+        start = time.perf_counter()
+        try:
+            endpoint = self.pool.choose(self.config.model_name)
+            async for token in self._astream_tokens(payload, endpoint):
+                yield token
         finally:
             duration = time.perf_counter() - start
             logger.info("LLM request completed in %.2f seconds", duration)
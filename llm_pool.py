@@ -0,0 +1,172 @@
+"""Routing of model requests over several LLM endpoints.
+
+Each endpoint has a weight and, optionally, the list of models it serves.
+A request goes to the healthy endpoint serving its model with the best
+score: the fewest outstanding requests per unit of weight, or the highest
+observed tokens per second per outstanding request. Every endpoint has its
+own :class:`circuit.CircuitBreaker`, so one that keeps failing, or keeps
+answering slower than ``slow_first_token``, is taken out of rotation until a
+probe succeeds. Load and speed are tracked per process and shared by every
+client, like the breakers.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+from circuit import CircuitBreaker, get_breaker
+from metrics import LLM_ENDPOINT_IN_FLIGHT, TokenTimer, feed_label
+
+LEAST_OUTSTANDING = "least_outstanding"
+TOKENS_PER_SECOND = "tokens_per_second"
+ROUTING = (LEAST_OUTSTANDING, TOKENS_PER_SECOND)
+# Weight of the latest response in an endpoint's tokens per second estimate
+SMOOTHING = 0.3
+
+
+@dataclass(frozen=True)
+class LLMEndpoint:
+    url: str
+    weight: float = 1.0
+    # Models served by the endpoint; empty means any
+    models: Tuple[str, ...] = ()
+
+    def serves(self, model: str) -> bool:
+        return not self.models or model in self.models
+
+
+def parse_endpoints(raw: str) -> List[LLMEndpoint]:
+    """Parse one ``url [weight=N] [models=a,b]`` line per endpoint."""
+    endpoints = []
+    for line in raw.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        options = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+        endpoints.append(
+            LLMEndpoint(
+                url=parts[0],
+                weight=float(options.get("weight", 1.0)),
+                models=tuple(m.strip() for m in options.get("models", "").split(",") if m.strip()),
+            )
+        )
+    return endpoints
+
+
+class _EndpointLoad:
+    def __init__(self):
+        self.outstanding = 0
+        self.tokens_per_second: Optional[float] = None
+
+
+_loads: Dict[str, _EndpointLoad] = {}
+_loads_lock = threading.Lock()
+
+
+class EndpointPool:
+    """Picks an endpoint for each request and tracks the outcome."""
+
+    def __init__(
+        self,
+        endpoints: List[LLMEndpoint],
+        routing: str = LEAST_OUTSTANDING,
+        failure_threshold: int = 5,
+        backoff: float = 30.0,
+        max_backoff: float = 600.0,
+        slow_first_token: float = 0.0,
+    ):
+        if not endpoints:
+            raise ValueError("At least one LLM endpoint is required")
+        if routing not in ROUTING:
+            raise ValueError(f"Unknown LLM routing '{routing}', expected one of {ROUTING}")
+        self.endpoints = endpoints
+        self.routing = routing
+        self.slow_first_token = slow_first_token
+        # Looked up once so that a pool built from an older configuration
+        # does not put back the thresholds of the newer one.
+        self._breakers = {
+            e.url: get_breaker(e.url, failure_threshold, backoff, max_backoff) for e in endpoints
+        }
+        with _loads_lock:
+            for endpoint in endpoints:
+                _loads.setdefault(endpoint.url, _EndpointLoad())
+
+    def breaker(self, endpoint: LLMEndpoint) -> CircuitBreaker:
+        return self._breakers[endpoint.url]
+
+    def _serving(self, model: str) -> List[LLMEndpoint]:
+        serving = [e for e in self.endpoints if e.serves(model)]
+        if not serving:
+            raise ValueError(f"No LLM endpoint serves model '{model}'")
+        return serving
+
+    def available(self, model: str) -> bool:
+        """Whether any endpoint serving ``model`` would accept a request now."""
+        return any(self.breaker(e).available() for e in self._serving(model))
+
+    def _score(self, endpoint: LLMEndpoint, fastest: float) -> float:
+        load = _loads[endpoint.url]
+        if self.routing == TOKENS_PER_SECOND:
+            # Unmeasured endpoints are assumed as fast as the fastest one, so
+            # they get traffic and a measurement.
+            speed = load.tokens_per_second or fastest
+            return endpoint.weight * speed / (load.outstanding + 1)
+        return endpoint.weight / (load.outstanding + 1)
+
+    def choose(self, model: str, exclude: Collection[str] = ()) -> LLMEndpoint:
+        """Return the best endpoint for ``model``.
+
+        Endpoints whose circuit is open are skipped, and so are the URLs in
+        ``exclude``, e.g. those that already failed this request, as long as
+        another endpoint is left. If every endpoint is open one is returned
+        anyway and its breaker raises :class:`circuit.CircuitOpen`.
+        """
+        serving = self._serving(model)
+        healthy = [e for e in serving if self.breaker(e).available()]
+        candidates = [e for e in healthy if e.url not in exclude] or healthy or serving
+        if len(candidates) == 1:
+            return candidates[0]
+        with _loads_lock:
+            fastest = max((_loads[e.url].tokens_per_second or 0.0 for e in candidates), default=0.0)
+            scored = [(self._score(e, fastest or 1.0), e) for e in candidates]
+        best = max(score for score, _ in scored)
+        return random.choice([e for score, e in scored if score == best])
+
+    def has_alternative(self, model: str, exclude: Collection[str]) -> bool:
+        """Whether a healthy endpoint outside ``exclude`` serves ``model``."""
+        return any(
+            e.url not in exclude and self.breaker(e).available() for e in self._serving(model)
+        )
+
+    @contextmanager
+    def outstanding(self, endpoint: LLMEndpoint) -> Iterator[None]:
+        """Count a request against ``endpoint`` while it runs."""
+        load = _loads[endpoint.url]
+        gauge = LLM_ENDPOINT_IN_FLIGHT.labels(endpoint=feed_label(endpoint.url))
+        with _loads_lock:
+            load.outstanding += 1
+        gauge.inc()
+        try:
+            yield
+        finally:
+            with _loads_lock:
+                load.outstanding -= 1
+            gauge.dec()
+
+    def record_success(self, endpoint: LLMEndpoint, timer: TokenTimer) -> None:
+        """Feed a finished response's speed and latency into the endpoint's state."""
+        if timer.rate is not None:
+            load = _loads[endpoint.url]
+            with _loads_lock:
+                previous = load.tokens_per_second
+                load.tokens_per_second = (
+                    timer.rate if previous is None else SMOOTHING * timer.rate + (1 - SMOOTHING) * previous
+                )
+        breaker = self.breaker(endpoint)
+        first_token = None if timer.first is None else timer.first - timer.start
+        if self.slow_first_token and first_token is not None and first_token > self.slow_first_token:
+            # Answering, but too slowly: counts towards ejection like an error.
+            breaker.record_failure()
+        else:
+            breaker.record_success()
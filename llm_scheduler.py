@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from llm_client import LLMConfig
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes; lower values are served first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+LANE_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a lane's queue is full and the request was rejected."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request did not finish before its deadline."""
+
+
+class _Waiter:
+    __slots__ = ("priority", "wake", "granted", "cancelled")
+
+    def __init__(self, priority: int, wake: Callable[[], None]):
+        self.priority = priority
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class LLMScheduler:
+    """Admission control in front of the model endpoint.
+
+    At most ``max_in_flight`` requests run at once. Further requests wait in
+    per-priority queues, interactive before background, and are rejected
+    with :class:`SchedulerOverloaded` once their lane holds ``max_queue``
+    waiters. The scheduler is shared by threads and event loops alike, so
+    the Celery worker and the async callers can use the same instance.
+    """
+
+    def __init__(self, max_in_flight: int = 2, max_queue: Optional[Dict[int, int]] = None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue or {INTERACTIVE: 32, BACKGROUND: 1000}
+        self._lock = threading.Lock()
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._depth = {lane: 0 for lane in self.max_queue}
+        self._in_flight = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _try_admit(self, priority: int, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """Take a slot immediately or enqueue a waiter; called under the lock."""
+        if self._in_flight < self.max_in_flight and not any(self._depth.values()):
+            self._in_flight += 1
+            return None
+        if self._depth.get(priority, 0) >= self.max_queue.get(priority, 0):
+            self.rejected += 1
+            raise SchedulerOverloaded(
+                f"{LANE_NAMES.get(priority, priority)} LLM queue is full"
+            )
+        waiter = _Waiter(priority, wake)
+        heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+        self._depth[priority] += 1
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if waiter.granted:
+                self._release_locked()
+            else:
+                waiter.cancelled = True
+                self._depth[waiter.priority] -= 1
+
+    def _grant_next_locked(self) -> bool:
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self._depth[waiter.priority] -= 1
+            waiter.wake()
+            return True
+        return False
+
+    def _release_locked(self) -> None:
+        # Hand the slot straight to the next waiter, unless the scheduler has
+        # been shrunk below the requests still running.
+        if self._in_flight <= self.max_in_flight and self._grant_next_locked():
+            return
+        self._in_flight -= 1
+
+    def resize(self, max_in_flight: int, max_queue: Dict[int, int]) -> None:
+        """Apply new limits; running and queued requests are kept."""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            self.max_queue = dict(max_queue)
+            for lane in self.max_queue:
+                self._depth.setdefault(lane, 0)
+            while self._in_flight < self.max_in_flight and self._grant_next_locked():
+                self._in_flight += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._release_locked()
+
+    async def acquire(self, priority: int = BACKGROUND) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            waiter = self._try_admit(priority, wake)
+        if waiter is None:
+            return
+        try:
+            await future
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def acquire_sync(self, priority: int = BACKGROUND, timeout: Optional[float] = None) -> None:
+        event = threading.Event()
+        with self._lock:
+            waiter = self._try_admit(priority, event.set)
+        if waiter is None:
+            return
+        if event.wait(timeout):
+            return
+        with self._lock:
+            if waiter.granted:
+                # The slot arrived just as the wait timed out; keep it.
+                return
+            waiter.cancelled = True
+            self._depth[waiter.priority] -= 1
+            self.timed_out += 1
+        raise DeadlineExceeded(f"Waited more than {timeout}s for an LLM slot")
+
+    @asynccontextmanager
+    async def slot(self, priority: int = BACKGROUND) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def slot_sync(self, priority: int = BACKGROUND, timeout: Optional[float] = None) -> Iterator[None]:
+        self.acquire_sync(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[Any]],
+        priority: int = BACKGROUND,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """Run ``call`` in a slot; ``timeout`` covers queueing and execution."""
+
+        async def scheduled() -> Any:
+            async with self.slot(priority):
+                return await call()
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(scheduled(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise DeadlineExceeded(
+                f"LLM request exceeded its {timeout}s deadline"
+            ) from None
+        finally:
+            logger.debug(
+                "%s LLM request finished after %.2f seconds",
+                LANE_NAMES.get(priority, priority),
+                time.perf_counter() - start,
+            )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {"in_flight": self._in_flight, "rejected": self.rejected, "timed_out": self.timed_out}
+            for lane, depth in self._depth.items():
+                stats[f"queued_{LANE_NAMES.get(lane, lane)}"] = depth
+            return stats
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config: LLMConfig) -> LLMScheduler:
+    """Return the process-wide scheduler, sized by ``config``.
+
+    A reloaded configuration with other limits resizes the existing scheduler.
+    """
+    global _scheduler
+    max_queue = {
+        INTERACTIVE: config.interactive_queue_depth,
+        BACKGROUND: config.background_queue_depth,
+    }
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler(config.max_in_flight, max_queue)
+        elif (_scheduler.max_in_flight, _scheduler.max_queue) != (config.max_in_flight, max_queue):
+            _scheduler.resize(config.max_in_flight, max_queue)
+        return _scheduler
+
+
+def lane_timeout(config: LLMConfig, priority: int) -> float:
+    if priority == INTERACTIVE:
+        return config.interactive_deadline
+    return config.background_deadline
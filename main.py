@@ -1,30 +1,49 @@
 import asyncio
+import json
 import logging
-from urllib.parse import urlparse
+from dataclasses import replace
+from urllib.parse import urlencode, urlparse
 
-from fastapi import FastAPI, HTTPException, Query, Request, Form
-from fastapi.responses import HTMLResponse
-from fastapi.responses import Response
+import orjson
+
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Form
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from typing import Optional
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 from rss_parser import parse_rss, DEFAULT_LIMIT
 from llm_client import LLMClient, LLMConfig
-from cache import SimpleCache
+from circuit import CircuitOpen
+from llm_scheduler import INTERACTIVE, DeadlineExceeded, SchedulerOverloaded
+from rewriter import record_job_failure, rewrite_text
+from cache import LRUCache
 from db import (
-    store_processed_article,
-    store_rewritten_article,
+    enqueue_rewrite_jobs,
+    claim_rewrite_jobs,
+    complete_rewrite_jobs,
+    release_rewrite_jobs,
+    get_duplicate_of,
+    get_articles_version,
     get_rewritten_article,
     list_rewritten_articles,
-    list_rewritten_articles_with_id,
+    backfill_rendered_html,
+    search_articles,
     delete_rewritten_articles,
     compute_hash,
 )
 from fastapi.responses import RedirectResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 import uvicorn
 
-app = FastAPI()
+import events
+import http_cache
+import settings
+from metrics import HTTP_READ_RESPONSES, CacheCollector
+from render import render_markdown
+
+app = FastAPI(default_response_class=ORJSONResponse)
 logging.basicConfig(level=logging.INFO)
 
 app.add_middleware(
@@ -36,7 +55,46 @@ app.add_middleware(
 
 templates = Jinja2Templates(directory="templates")
 
-feed_cache = SimpleCache(ttl=600)
+# Feeds are cached whole, keyed by URL, and sliced per request
+feed_cache = LRUCache(ttl=600, max_entries=256, max_bytes=32 * 1024 * 1024)
+# Rendered, compressed responses of the read endpoints. Keys include the
+# version of the stored articles, so a write makes every page miss.
+response_cache = LRUCache(ttl=600, max_entries=1024, max_bytes=32 * 1024 * 1024)
+REGISTRY.register(CacheCollector({"feed": feed_cache, "response": response_cache}))
+
+# Upper bound for the ``limit`` parameter of /summarize. A request rewrites at
+# most max_in_flight of its articles at a time, so it never takes more than
+# that many places in the interactive LLM queue.
+MAX_SUMMARIZE_LIMIT = 50
+
+# Default and maximum number of articles per page on the read endpoints
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# /articles/stream checks the database this often for articles stored by other
+# processes, which do not notify this one, and sends a keep-alive otherwise.
+LIVE_POLL_INTERVAL = 15.0
+
+
+@app.exception_handler(SchedulerOverloaded)
+async def llm_overloaded(request: Request, exc: SchedulerOverloaded):
+    return JSONResponse(
+        status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "30"}
+    )
+
+
+@app.exception_handler(CircuitOpen)
+async def llm_circuit_open(request: Request, exc: CircuitOpen):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, int(exc.retry_in)))},
+    )
+
+
+@app.exception_handler(DeadlineExceeded)
+async def llm_deadline_exceeded(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
 
 
 def validate_url(url: str) -> str:
@@ -46,23 +104,282 @@ def validate_url(url: str) -> str:
     return url
 
 
-async def rewrite_article(article: dict, llm: LLMClient, prompt_template: str) -> dict:
+def fetch_article_page(
+    before_id: Optional[int], limit: int
+) -> Tuple[List[dict], Optional[int]]:
+    """Return one page of articles and the cursor for the next page."""
+    rows = list_rewritten_articles(before_id, limit + 1)
+    next_before_id = rows[limit - 1]["id"] if len(rows) > limit else None
+    return rows[:limit], next_before_id
+
+
+def search_article_page(
+    q: str, offset: int, limit: int
+) -> Tuple[List[dict], Optional[int]]:
+    """Return one page of search results and the offset of the next page."""
+    rows = search_articles(q, limit + 1, offset)
+    next_offset = offset + limit if len(rows) > limit else None
+    return rows[:limit], next_offset
+
+
+async def rewrite_article(
+    article: dict,
+    llm: LLMClient,
+    prompt_template: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    reuse_stored: bool = True,
+) -> dict:
+    """Rewrite one article, reusing earlier work where possible.
+
+    Rewrites are looked up in the rewrite cache, which is keyed by model and
+    prompt. ``reuse_stored`` additionally allows returning the article as
+    stored by the feed manager, which is only correct for the configured
+    default model and prompt; without it the article is neither queued nor
+    stored. When ``on_token`` is given a fresh rewrite is streamed and every
+    raw token is passed to it as it arrives.
+    """
+    if not reuse_stored:
+        rewritten = await rewrite_text(article, llm, prompt_template, on_token, INTERACTIVE)
+        return _rewrite_result(article, rewritten)
+
     h = compute_hash(article["title"], article.get("date", ""))
-    if not store_processed_article(article["title"], article["link"], article.get("date", "")):
-        existing = get_rewritten_article(h)
+    is_new = (
+        await asyncio.to_thread(
+            enqueue_rewrite_jobs,
+            [article],
+            "api",
+            llm.config.duplicate_max_distance,
+            llm.config.duplicate_window,
+        )
+    )[0]
+    # A near-duplicate shares the rewrite of the article it was linked to,
+    # but keeps its own title, link and date.
+    original = await asyncio.to_thread(get_duplicate_of, h)
+    if original or not is_new:
+        existing = await asyncio.to_thread(get_rewritten_article, original or h)
         if existing:
-            return existing
+            return {
+                "title": article["title"],
+                "link": article["link"],
+                "content": existing["content"],
+                "content_html": existing["content_html"],
+                "date": article.get("date", ""),
+            }
+
+    # Take over the article's queued job unless another worker holds it, so
+    # a failure here leaves the job to be retried in the background. Only a
+    # claimed job stores its result; otherwise its holder does.
+    jobs = await asyncio.to_thread(
+        claim_rewrite_jobs, 1, llm.config.job_lease, llm.config.job_max_attempts, [h]
+    )
+    try:
+        rewritten = await rewrite_text(article, llm, prompt_template, on_token, INTERACTIVE)
+    except asyncio.CancelledError:
+        # The client went away; hand the job straight back.
+        if jobs:
+            await asyncio.shield(asyncio.to_thread(release_rewrite_jobs, [jobs[0]["id"]]))
+        raise
+    except Exception as exc:
+        if jobs:
+            await asyncio.to_thread(record_job_failure, jobs[0], exc, llm)
+        raise
+    result = _rewrite_result(article, rewritten)
+    if jobs:
+        await asyncio.to_thread(complete_rewrite_jobs, [(jobs[0]["id"], result)])
+    return result
+
 
-    prompt = prompt_template.format(title=article["title"], summary=article["summary"])
-    rewritten = await asyncio.to_thread(llm.generate, prompt)
-    result = {
+def _rewrite_result(article: dict, rewritten: str) -> dict:
+    return {
         "title": article["title"],
         "link": article["link"],
         "content": rewritten,
+        "content_html": render_markdown(rewritten),
         "date": article.get("date", ""),
     }
-    store_rewritten_article(result["title"], result["link"], result["content"], result["date"])
-    return result
+
+
+async def load_articles(rss_url: str, limit: int) -> List[dict]:
+    entries = await feed_cache.get_or_fetch(
+        rss_url, lambda: asyncio.to_thread(parse_rss, rss_url, None)
+    )
+    return entries[:limit]
+
+
+def load_llm_config(model: Optional[str], prompt: Optional[str]) -> LLMConfig:
+    """The current LLM settings, with this request's overrides applied to a copy."""
+    config = settings.get(LLMConfig.from_parser)
+    if model:
+        config = replace(config, model_name=model)
+    if prompt:
+        config = replace(config, rewrite_prompt=prompt)
+    return config
+
+
+async def cached_read(
+    request: Request, endpoint: str, media_type: str, render: Callable[[], bytes]
+) -> Response:
+    """Serve a read endpoint from the response cache, or not at all.
+
+    Requests whose ``If-None-Match`` or ``If-Modified-Since`` is still current
+    get a 304. Otherwise the body produced by ``render`` is compressed for the
+    client and kept until the articles change; concurrent misses for the same
+    page render it once.
+    """
+    version, modified = await asyncio.to_thread(get_articles_version)
+    tag = http_cache.etag(version)
+    headers = {
+        "ETag": tag,
+        "Last-Modified": http_cache.http_date(modified),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if http_cache.not_modified(request.headers, tag, modified):
+        HTTP_READ_RESPONSES.labels(endpoint=endpoint, result="not_modified").inc()
+        return Response(status_code=304, headers=headers)
+
+    encoding = http_cache.negotiate_encoding(request.headers.get("accept-encoding"))
+    query = urlencode(sorted(request.query_params.multi_items()))
+    key = f"{version}:{encoding}:{request.url.path}?{query}"
+    result = "cached"
+
+    def build() -> Tuple[bytes, str]:
+        body = render()
+        if encoding == http_cache.IDENTITY or len(body) < http_cache.MIN_COMPRESS_SIZE:
+            return body, http_cache.IDENTITY
+        return http_cache.compress(body, encoding), encoding
+
+    async def fetch() -> Tuple[bytes, str]:
+        nonlocal result
+        result = "rendered"
+        return await asyncio.to_thread(build)
+
+    body, used = await response_cache.get_or_fetch(key, fetch)
+    HTTP_READ_RESPONSES.labels(endpoint=endpoint, result=result).inc()
+    if used != http_cache.IDENTITY:
+        headers["Content-Encoding"] = used
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def _encode_event(event: dict, sse: bool) -> str:
+    data = json.dumps(event)
+    if sse:
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+async def stream_rewrites(
+    articles: List[dict], config: LLMConfig, tokens: bool, sse: bool, reuse_stored: bool
+) -> AsyncIterator[str]:
+    """Yield one event per article as soon as its rewrite is done.
+
+    With ``tokens`` enabled, ``token`` events carrying the raw model output
+    are interleaved before each article's final ``article`` event.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    slots = asyncio.Semaphore(config.max_in_flight)
+
+    async def run(index: int, article: dict, llm: LLMClient) -> None:
+        on_token = None
+        if tokens:
+            on_token = lambda token: queue.put_nowait(
+                {"type": "token", "index": index, "token": token}
+            )
+        try:
+            async with slots:
+                result = await rewrite_article(
+                    article, llm, config.rewrite_prompt, on_token, reuse_stored
+                )
+            queue.put_nowait({"type": "article", "index": index, "article": result})
+        except Exception as exc:
+            logging.error("Failed to rewrite %s: %s", article.get("title"), exc)
+            queue.put_nowait({"type": "error", "index": index, "detail": str(exc)})
+
+    async with LLMClient(config) as llm:
+        workers = [
+            asyncio.create_task(run(index, article, llm))
+            for index, article in enumerate(articles)
+        ]
+        try:
+            remaining = len(workers)
+            while remaining:
+                event = await queue.get()
+                if event["type"] != "token":
+                    remaining -= 1
+                yield _encode_event(event, sse)
+            yield _encode_event({"type": "done", "count": len(articles)}, sse)
+        finally:
+            # The client may disconnect mid-stream.
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def _encode_sse(event: str, data: str, event_id: Optional[int] = None) -> str:
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.extend(f"data: {line}" for line in data.splitlines() or [""])
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_new_articles(after_id: Optional[int]) -> AsyncIterator[str]:
+    """Yield an ``articles`` event with the HTML of each batch of new articles.
+
+    The event id is the newest article id sent, so a reconnecting browser
+    resumes from ``Last-Event-ID``. If more than a page has piled up while it
+    was away, a ``reset`` event tells the page to reload the list instead.
+    """
+    fragment = templates.get_template("article_list.html")
+    with events.subscribe() as subscription:
+        if after_id is None:
+            newest = await asyncio.to_thread(list_rewritten_articles, None, 1)
+            after_id = newest[0]["id"] if newest else 0
+        # Tell the browser where it is even if nothing new arrives before it
+        # has to reconnect.
+        yield _encode_sse("ready", "", after_id)
+        while True:
+            rows = await asyncio.to_thread(
+                list_rewritten_articles, None, MAX_PAGE_SIZE + 1, after_id
+            )
+            if len(rows) > MAX_PAGE_SIZE:
+                after_id = rows[0]["id"]
+                yield _encode_sse("reset", "", after_id)
+            elif rows:
+                after_id = rows[0]["id"]
+                yield _encode_sse("articles", fragment.render(articles=rows).strip(), after_id)
+            if not await subscription.wait(LIVE_POLL_INTERVAL):
+                yield ": keep-alive\n\n"
+
+
+@app.on_event("startup")
+async def reload_config_on_sighup():
+    settings.reload_on_sighup()
+
+
+@app.on_event("startup")
+async def start_cache_sweeper():
+    feed_cache.start_sweeper()
+
+
+@app.on_event("startup")
+async def start_html_backfill():
+    async def backfill() -> None:
+        count = await asyncio.to_thread(backfill_rendered_html)
+        if count:
+            logging.info("Rendered HTML for %d stored articles", count)
+
+    app.state.html_backfill = asyncio.create_task(backfill())
+
+
+@app.on_event("shutdown")
+async def stop_cache_sweeper():
+    feed_cache.stop_sweeper()
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/summarize")
@@ -70,31 +387,56 @@ async def summarize_rss(
     rss_url: str = Query(..., alias="rss_url"),
     model: Optional[str] = None,
     prompt: Optional[str] = None,
-    limit: int = DEFAULT_LIMIT,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_SUMMARIZE_LIMIT),
 ):
     validate_url(rss_url)
 
-    cache_key = f"{rss_url}:{limit}"
-    articles = feed_cache.get(cache_key)
-    if articles is None:
-        articles = await asyncio.to_thread(parse_rss, rss_url, limit)
-        feed_cache.set(cache_key, articles)
+    articles = await load_articles(rss_url, limit)
+    config = load_llm_config(model, prompt)
+
+    reuse_stored = not (model or prompt)
+    slots = asyncio.Semaphore(config.max_in_flight)
+
+    async def run(article: dict, llm: LLMClient) -> dict:
+        async with slots:
+            return await rewrite_article(
+                article, llm, config.rewrite_prompt, reuse_stored=reuse_stored
+            )
+
+    async with LLMClient(config) as llm:
+        tasks = [asyncio.create_task(run(article, llm)) for article in articles]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # One failed rewrite fails the request; stop the others before
+            # their client closes.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    config = LLMConfig.load()
-    if model:
-        config.model_name = model
-    if prompt:
-        config.rewrite_prompt = prompt
+    return {"articles": results}
 
-    results = []
-    with LLMClient(config) as llm:
-        tasks = [
-            rewrite_article(article, llm, config.rewrite_prompt)
-            for article in articles
-        ]
-        results = await asyncio.gather(*tasks)
 
-    return {"articles": results}
+@app.get("/summarize/stream")
+async def summarize_rss_stream(
+    request: Request,
+    rss_url: str = Query(..., alias="rss_url"),
+    model: Optional[str] = None,
+    prompt: Optional[str] = None,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_SUMMARIZE_LIMIT),
+    tokens: bool = False,
+):
+    validate_url(rss_url)
+    articles = await load_articles(rss_url, limit)
+    config = load_llm_config(model, prompt)
+
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(
+        stream_rewrites(articles, config, tokens, sse, reuse_stored=not (model or prompt)),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/", include_in_schema=False)
@@ -110,34 +452,97 @@ async def show_articles(request: Request):
 
 
 @app.get("/article_list", response_class=HTMLResponse)
-async def article_list(request: Request):
-    articles = list_rewritten_articles()
-    return templates.TemplateResponse(
-        "article_list.html", {"request": request, "articles": articles}
+async def article_list(
+    request: Request,
+    before_id: Optional[int] = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    q: str = "",
+    offset: int = Query(0, ge=0),
+):
+    q = q.strip()
+
+    def render() -> bytes:
+        context = {"request": request, "limit": limit, "q": q}
+        if q:
+            articles, next_offset = search_article_page(q, offset, limit)
+            context.update(articles=articles, next_offset=next_offset, first_page=offset == 0)
+        else:
+            articles, next_before_id = fetch_article_page(before_id, limit)
+            context.update(
+                articles=articles, next_before_id=next_before_id, first_page=before_id is None
+            )
+        return templates.get_template("article_list.html").render(context).encode()
+
+    return await cached_read(request, "article_list", "text/html; charset=utf-8", render)
+
+
+@app.get("/articles/stream")
+async def article_stream(
+    after_id: Optional[int] = Query(None, ge=0),
+    last_event_id: Optional[int] = Header(None, ge=0),
+):
+    """Push the HTML of newly stored articles as Server-Sent Events.
+
+    Starts after ``after_id``, or the newest article when omitted; the
+    ``Last-Event-ID`` header of a reconnect takes precedence.
+    """
+    if last_event_id is not None:
+        after_id = last_event_id
+    return StreamingResponse(
+        stream_new_articles(after_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 @app.get("/api/articles")
-async def api_articles():
-    return {"articles": list_rewritten_articles()}
+async def api_articles(
+    request: Request,
+    before_id: Optional[int] = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    def render() -> bytes:
+        articles, next_before_id = fetch_article_page(before_id, limit)
+        return orjson.dumps({"articles": articles, "next_before_id": next_before_id})
+
+    return await cached_read(request, "api_articles", "application/json", render)
+
+
+@app.get("/api/search")
+async def api_search(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+):
+    def render() -> bytes:
+        results, next_offset = search_article_page(q, offset, limit)
+        return orjson.dumps({"query": q, "results": results, "next_offset": next_offset})
+
+    return await cached_read(request, "api_search", "application/json", render)
 
 
 @app.get("/edit", response_class=HTMLResponse)
-async def edit_articles(request: Request):
-    articles = list_rewritten_articles_with_id()
+async def edit_articles(
+    request: Request,
+    before_id: Optional[int] = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    articles, next_before_id = await asyncio.to_thread(fetch_article_page, before_id, limit)
     return templates.TemplateResponse(
-        "edit.html", {"request": request, "articles": articles}
+        "edit.html",
+        {"request": request, "articles": articles, "next_before_id": next_before_id},
     )
 
 
 @app.post("/edit")
 async def delete_articles(ids: list[int] = Form(...)):
-    delete_rewritten_articles(ids)
+    await asyncio.to_thread(delete_rewritten_articles, ids)
     return RedirectResponse(url="/edit", status_code=303)
 
 
 @app.post("/delete/{article_id}")
 async def delete_article(article_id: int):
-    delete_rewritten_articles([article_id])
+    await asyncio.to_thread(delete_rewritten_articles, [article_id])
     return Response(status_code=204)
 
 
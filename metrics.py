@@ -0,0 +1,180 @@
+"""Prometheus metrics for the fetch, parse, LLM and database stages.
+
+The API exposes them on ``/metrics``; the feed manager can serve its own with
+``--metrics-port``. Feed metrics are labelled by feed host so that arbitrary
+``/summarize`` URLs cannot blow up the label cardinality.
+"""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+FEED_FETCH_SECONDS = Histogram(
+    "feedpulse_feed_fetch_seconds",
+    "Time spent downloading a feed",
+    ["feed", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+FEED_PARSE_SECONDS = Histogram(
+    "feedpulse_feed_parse_seconds",
+    "Time spent parsing a feed document",
+    ["feed"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "feedpulse_llm_request_seconds",
+    "Duration of a single LLM HTTP request",
+    ["model", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "feedpulse_llm_time_to_first_token_seconds",
+    "Time from sending a prompt until the first token arrives",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "feedpulse_llm_tokens_per_second",
+    "Generation speed after the first token",
+    ["model"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400),
+)
+LLM_RETRIES = Counter(
+    "feedpulse_llm_retries_total",
+    "LLM requests retried after an error",
+    ["model"],
+)
+PROMPT_INPUT_TOKENS = Histogram(
+    "feedpulse_prompt_input_tokens",
+    "Estimated tokens of an article summary after preprocessing",
+    ["model"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+PROMPT_TOKENS_SAVED = Counter(
+    "feedpulse_prompt_tokens_saved_total",
+    "Estimated summary tokens removed by preprocessing before prompting",
+    ["model"],
+)
+PROMPT_TRUNCATED = Counter(
+    "feedpulse_prompt_truncated_total",
+    "Summaries cut to the model's input token budget",
+    ["model"],
+)
+REWRITE_CACHE_LOOKUPS = Counter(
+    "feedpulse_rewrite_cache_lookups",
+    "Rewrite cache lookups by result (hit or miss)",
+    ["result"],
+)
+NEAR_DUPLICATES = Counter(
+    "feedpulse_near_duplicates_total",
+    "New articles linked to an earlier article's rewrite instead of being rewritten",
+)
+LLM_BATCH_ARTICLES = Histogram(
+    "feedpulse_llm_batch_articles",
+    "Articles answered by one batched rewrite prompt",
+    buckets=(2, 3, 4, 6, 8, 12, 16, 24, 32),
+)
+LLM_BATCH_FALLBACKS = Counter(
+    "feedpulse_llm_batch_fallbacks_total",
+    "Articles rewritten on their own after a batched prompt failed or left them out",
+)
+LLM_ENDPOINT_IN_FLIGHT = Gauge(
+    "feedpulse_llm_endpoint_in_flight",
+    "Requests currently outstanding against an LLM endpoint",
+    ["endpoint"],
+)
+CIRCUIT_STATE = Gauge(
+    "feedpulse_circuit_state",
+    "Circuit breaker state: 0 closed, 1 open, 2 half-open",
+    ["circuit"],
+)
+DB_WRITE_SECONDS = Histogram(
+    "feedpulse_db_write_seconds",
+    "Time a caller waits for a database write, including queueing",
+    ["op"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_COMMIT_SECONDS = Histogram(
+    "feedpulse_db_commit_seconds",
+    "Time the writer thread spends on one grouped transaction",
+    buckets=LATENCY_BUCKETS,
+)
+DB_COMMIT_OPS = Histogram(
+    "feedpulse_db_commit_ops",
+    "Write operations grouped into one transaction",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 256),
+)
+HTTP_READ_RESPONSES = Counter(
+    "feedpulse_http_read_responses",
+    "Responses of the cached read endpoints by how they were produced",
+    ["endpoint", "result"],
+)
+
+
+def feed_label(url: str) -> str:
+    return urlparse(url).netloc.lower() or "unknown"
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+class TokenTimer:
+    """Tracks time to first token and generation speed of one LLM response."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.tokens = 0
+        self.rate: Optional[float] = None
+
+    def token(self) -> None:
+        if self.first is None:
+            self.first = time.perf_counter()
+            LLM_TIME_TO_FIRST_TOKEN_SECONDS.labels(model=self.model).observe(self.first - self.start)
+        self.tokens += 1
+
+    def finish(self, outcome: str) -> None:
+        end = time.perf_counter()
+        LLM_REQUEST_SECONDS.labels(model=self.model, outcome=outcome).observe(end - self.start)
+        if self.first is not None and self.tokens > 1 and end > self.first:
+            self.rate = (self.tokens - 1) / (end - self.first)
+            LLM_TOKENS_PER_SECOND.labels(model=self.model).observe(self.rate)
+
+
+class CacheCollector:
+    """Exports the counters of :class:`cache.LRUCache` instances by name."""
+
+    def __init__(self, caches: Dict[str, Any]):
+        self.caches = caches
+
+    def collect(self):
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        for key in ("hits", "misses", "evictions", "expirations"):
+            counter = CounterMetricFamily(
+                f"feedpulse_cache_{key}", f"Cache {key}", labels=["cache"]
+            )
+            for name, values in stats.items():
+                counter.add_metric([name], values[key])
+            yield counter
+        for key in ("entries", "bytes"):
+            gauge = GaugeMetricFamily(f"feedpulse_cache_{key}", f"Cache {key}", labels=["cache"])
+            for name, values in stats.items():
+                gauge.add_metric([name], values[key])
+            yield gauge
+        ratio = GaugeMetricFamily("feedpulse_cache_hit_ratio", "Cache hit ratio", labels=["cache"])
+        for name, values in stats.items():
+            lookups = values["hits"] + values["misses"]
+            ratio.add_metric([name], values["hits"] / lookups if lookups else 0.0)
+        yield ratio
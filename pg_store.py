@@ -0,0 +1,861 @@
+"""PostgreSQL implementation of the storage functions in :mod:`db`.
+
+Selected with ``backend = postgresql`` in the ``[DATABASE]`` section of
+``config.ini``. Connections come from a ``psycopg_pool`` pool, so the API,
+the feed manager and any number of Celery workers can write at the same time.
+Every public function of :mod:`db` that touches the database has a method of
+the same name and signature here.
+
+Rows are written in bulk with ``INSERT ... SELECT FROM unnest(...) ON CONFLICT``.
+Rewrite jobs are claimed with ``FOR UPDATE SKIP LOCKED`` so that concurrent
+workers never block each other or take the same job. Search uses a weighted
+``tsvector`` column with a GIN index in place of the SQLite FTS5 table.
+"""
+import html
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+import events
+import simhash
+from circuit import backoff_delay
+from db import (
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_IN_PROGRESS,
+    JOB_PENDING,
+    SEARCH_TITLE_WEIGHT,
+    DatabaseConfig,
+    _rewritten_rows,
+    compute_hash,
+)
+from metrics import DB_WRITE_SECONDS, NEAR_DUPLICATES, REWRITE_CACHE_LOOKUPS, timed
+from render import render_markdown
+
+_NOW_TEXT = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS processed_articles (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        title TEXT,
+        link TEXT,
+        date TEXT,
+        hash TEXT UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewritten_articles (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        title TEXT,
+        link TEXT,
+        content TEXT,
+        date TEXT,
+        hash TEXT UNIQUE,
+        content_html TEXT,
+        search tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A')
+            || setweight(to_tsvector('simple', coalesce(content, '')), 'D')
+        ) STORED
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS rewritten_articles_search ON rewritten_articles USING GIN (search)",
+    """
+    CREATE TABLE IF NOT EXISTS feed_status (
+        url TEXT PRIMARY KEY,
+        checked_at TEXT,
+        success INTEGER,
+        reason TEXT,
+        failures INTEGER DEFAULT 0,
+        next_retry_at DOUBLE PRECISION
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_validators (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewrite_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        content TEXT,
+        created_at DOUBLE PRECISION,
+        last_used_at DOUBLE PRECISION,
+        hits INTEGER DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS rewrite_cache_last_used ON rewrite_cache (last_used_at)",
+    """
+    CREATE TABLE IF NOT EXISTS feed_watermarks (
+        url TEXT PRIMARY KEY,
+        last_guid TEXT,
+        last_published DOUBLE PRECISION,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_schedule (
+        url TEXT PRIMARY KEY,
+        next_poll_at DOUBLE PRECISION,
+        interval DOUBLE PRECISION,
+        publish_interval DOUBLE PRECISION,
+        last_polled_at DOUBLE PRECISION
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rewrite_jobs (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        hash TEXT UNIQUE,
+        source TEXT,
+        article TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until DOUBLE PRECISION,
+        last_error TEXT,
+        created_at DOUBLE PRECISION,
+        updated_at DOUBLE PRECISION
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS rewrite_jobs_status ON rewrite_jobs (status, lease_until)",
+    """
+    CREATE TABLE IF NOT EXISTS article_simhash (
+        hash TEXT PRIMARY KEY,
+        simhash BIGINT NOT NULL,
+        created_at DOUBLE PRECISION
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS article_simhash_created ON article_simhash (created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS article_simhash_buckets (
+        bucket BIGINT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (bucket, hash)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS article_duplicates (
+        hash TEXT PRIMARY KEY,
+        duplicate_of TEXT NOT NULL,
+        link TEXT,
+        source TEXT,
+        distance INTEGER,
+        created_at DOUBLE PRECISION
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS article_duplicates_of ON article_duplicates (duplicate_of)",
+    """
+    CREATE TABLE IF NOT EXISTS data_version (
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL,
+        updated_at DOUBLE PRECISION
+    )
+    """,
+    """
+    INSERT INTO data_version (name, version, updated_at)
+    VALUES ('articles', 1, extract(epoch FROM now()))
+    ON CONFLICT (name) DO NOTHING
+    """,
+    """
+    CREATE OR REPLACE FUNCTION bump_articles_version() RETURNS trigger AS $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM changed_rows) THEN
+            UPDATE data_version SET version = version + 1, updated_at = extract(epoch FROM clock_timestamp())
+            WHERE name = 'articles';
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    # Once per statement, so a bulk insert touches the data_version row only
+    # once, and only if the statement changed rows: an INSERT ... ON CONFLICT
+    # DO NOTHING that inserts nothing must not invalidate cached pages.
+    "DROP TRIGGER IF EXISTS rewritten_articles_version ON rewritten_articles",
+    *(
+        statement
+        for event, table in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))
+        for statement in (
+            f"DROP TRIGGER IF EXISTS rewritten_articles_version_{event.lower()} ON rewritten_articles",
+            f"""
+            CREATE TRIGGER rewritten_articles_version_{event.lower()}
+            AFTER {event} ON rewritten_articles
+            REFERENCING {table} TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_articles_version()
+            """,
+        )
+    ),
+]
+
+# Serializes schema creation across processes starting at the same time
+_SCHEMA_LOCK_ID = 0x46504442
+
+_ARTICLE_COLUMNS = "id, title, link, content, date, content_html"
+
+
+def _article(row: tuple) -> Dict[str, Any]:
+    return {
+        "id": row[0],
+        "title": row[1],
+        "link": row[2],
+        "content": row[3],
+        "date": row[4],
+        "content_html": row[5],
+    }
+
+
+def _search_query(text: str) -> Tuple[str, List[str]]:
+    """Build a ``tsquery`` expression matching every term of ``text``.
+
+    Each term is parsed as a phrase with the same parser as the indexed text,
+    so input like ``CVE-2024-3400`` matches literally; a trailing ``*`` turns
+    the term's last word into a prefix.
+    """
+    parts = []
+    params = []
+    for term in text.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if not any(ch.isalnum() for ch in term):
+            continue
+        if prefix:
+            parts.append("(phraseto_tsquery('simple', %s)::text || ':*')::tsquery")
+        else:
+            parts.append("phraseto_tsquery('simple', %s)")
+        params.append(term)
+    return " && ".join(parts), params
+
+
+class PostgresStore:
+    """Storage backed by a pool of PostgreSQL connections."""
+
+    def __init__(self, config: DatabaseConfig):
+        self.pool = ConnectionPool(
+            config.dsn,
+            min_size=config.pool_min_size,
+            max_size=config.pool_max_size,
+            timeout=config.pool_timeout,
+            open=True,
+        )
+        self._write(self._ensure_schema)
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def _ensure_schema(self, conn: Connection) -> None:
+        conn.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK_ID,))
+        for statement in _SCHEMA:
+            conn.execute(statement)
+
+    def _read(self, query: str, params: Any = None) -> List[tuple]:
+        with self.pool.connection() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def _write(self, op: Callable[[Connection], Any]) -> Any:
+        """Run ``op`` in a transaction on a pooled connection."""
+        with timed(DB_WRITE_SECONDS, op=op.__name__):
+            with self.pool.connection() as conn:
+                return op(conn)
+
+    # Processed and rewritten articles
+
+    def _insert_processed(self, conn: Connection, articles: List[Dict[str, str]]) -> List[bool]:
+        hashes = [compute_hash(a["title"], a.get("date", "")) for a in articles]
+        inserted = {
+            row[0]
+            for row in conn.execute(
+                """
+                INSERT INTO processed_articles (title, link, date, hash)
+                SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[])
+                ON CONFLICT (hash) DO NOTHING
+                RETURNING hash
+                """,
+                (
+                    [a["title"] for a in articles],
+                    [a["link"] for a in articles],
+                    [a.get("date", "") for a in articles],
+                    hashes,
+                ),
+            ).fetchall()
+        }
+        # Only the first of several identical articles in one batch is new.
+        flags = []
+        for article_hash in hashes:
+            flags.append(article_hash in inserted)
+            inserted.discard(article_hash)
+        return flags
+
+    def store_processed_article(self, title: str, link: str, date: str) -> bool:
+        return self.store_processed_articles([{"title": title, "link": link, "date": date}])[0]
+
+    def store_processed_articles(self, articles: List[Dict[str, str]]) -> List[bool]:
+        if not articles:
+            return []
+
+        def store_processed_articles(conn: Connection) -> List[bool]:
+            return self._insert_processed(conn, articles)
+
+        return self._write(store_processed_articles)
+
+    def find_processed_hashes(self, hashes: List[str]) -> set:
+        if not hashes:
+            return set()
+        rows = self._read("SELECT hash FROM processed_articles WHERE hash = ANY(%s)", (hashes,))
+        return {row[0] for row in rows}
+
+    def _insert_rewritten(self, conn: Connection, rows: List[tuple]) -> int:
+        columns = list(zip(*rows))
+        cur = conn.execute(
+            """
+            INSERT INTO rewritten_articles (title, link, content, content_html, date, hash)
+            SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+            ON CONFLICT (hash) DO NOTHING
+            """,
+            [list(column) for column in columns],
+        )
+        return cur.rowcount
+
+    def store_rewritten_articles(self, articles: List[Dict[str, str]]) -> int:
+        if not articles:
+            return 0
+        rows = _rewritten_rows(articles)
+
+        def store_rewritten_articles(conn: Connection) -> int:
+            return self._insert_rewritten(conn, rows)
+
+        stored = self._write(store_rewritten_articles)
+        if stored:
+            events.publish()
+        return stored
+
+    def get_rewritten_article(self, article_hash: str) -> Optional[Dict[str, str]]:
+        rows = self._read(
+            "SELECT title, link, content, date, content_html FROM rewritten_articles WHERE hash = %s",
+            (article_hash,),
+        )
+        if rows:
+            row = rows[0]
+            return {
+                "title": row[0],
+                "link": row[1],
+                "content": row[2],
+                "date": row[3],
+                "content_html": row[4],
+            }
+        return None
+
+    def get_articles_version(self) -> Tuple[int, float]:
+        rows = self._read("SELECT version, updated_at FROM data_version WHERE name = 'articles'")
+        return rows[0][0], rows[0][1]
+
+    def list_rewritten_articles(
+        self,
+        before_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> List[Dict[str, str]]:
+        query = f"SELECT {_ARTICLE_COLUMNS} FROM rewritten_articles"
+        conditions = []
+        params: list = []
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(before_id)
+        if after_id is not None:
+            conditions.append("id > %s")
+            params.append(after_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        return [_article(row) for row in self._read(query, params)]
+
+    def search_articles(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+        match, params = _search_query(query)
+        if not match:
+            return []
+        # ts_rank weights are listed for D, C, B, A; titles are weighted A.
+        weights = "{%s, 0, 0, %s}" % (1.0 / SEARCH_TITLE_WEIGHT, 1.0)
+        rows = self._read(
+            f"""
+            WITH q AS (SELECT {match} AS query)
+            SELECT a.id, a.title, a.link, a.content, a.date, a.content_html,
+                   ts_headline('simple', coalesce(a.content, ''), q.query,
+                               'StartSel=' || chr(2) || ', StopSel=' || chr(3)
+                               || ', MaxWords=24, MinWords=12, HighlightAll=false'),
+                   ts_rank(%s::float4[], a.search, q.query) AS rank
+            FROM rewritten_articles AS a, q
+            WHERE a.search @@ q.query
+            ORDER BY rank DESC, a.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            (*params, weights, limit, offset),
+        )
+        return [
+            {
+                **_article(row),
+                "snippet": html.escape(row[6]).replace("\x02", "<mark>").replace("\x03", "</mark>"),
+                # Lower is better, as with SQLite's bm25().
+                "rank": -row[7],
+            }
+            for row in rows
+        ]
+
+    def backfill_rendered_html(self, batch_size: int = 200) -> int:
+        done = 0
+        last_id = 0
+        while True:
+            rows = self._read(
+                """
+                SELECT id, content FROM rewritten_articles
+                WHERE content_html IS NULL AND id > %s
+                ORDER BY id LIMIT %s
+                """,
+                (last_id, batch_size),
+            )
+            if not rows:
+                return done
+            last_id = rows[-1][0]
+            rendered = [(render_markdown(content or ""), row_id) for row_id, content in rows]
+
+            def backfill_rendered_html(conn: Connection) -> None:
+                conn.execute(
+                    """
+                    UPDATE rewritten_articles AS a SET content_html = v.html
+                    FROM unnest(%s::text[], %s::bigint[]) AS v(html, id)
+                    WHERE a.id = v.id
+                    """,
+                    ([html_ for html_, _ in rendered], [row_id for _, row_id in rendered]),
+                )
+
+            self._write(backfill_rendered_html)
+            done += len(rendered)
+
+    def delete_rewritten_articles(self, ids: List[int]) -> None:
+        if not ids:
+            return
+
+        def delete_rewritten_articles(conn: Connection) -> None:
+            conn.execute("DELETE FROM rewritten_articles WHERE id = ANY(%s)", (ids,))
+
+        self._write(delete_rewritten_articles)
+
+    # Feed state
+
+    def record_feed_status(
+        self,
+        url: str,
+        success: bool,
+        reason: str,
+        retry_after: Optional[float] = None,
+        backoff: float = 300.0,
+        max_backoff: float = 86400.0,
+    ) -> float:
+        def record_feed_status(conn: Connection) -> float:
+            row = conn.execute(
+                "SELECT failures FROM feed_status WHERE url = %s FOR UPDATE", (url,)
+            ).fetchone()
+            failures = 0 if success else (row[0] or 0 if row else 0) + 1
+            delay = 0.0 if success else max(
+                backoff_delay(failures, backoff, max_backoff), retry_after or 0
+            )
+            conn.execute(
+                f"""
+                INSERT INTO feed_status (url, checked_at, success, reason, failures, next_retry_at)
+                VALUES (%s, {_NOW_TEXT}, %s, %s, %s, %s)
+                ON CONFLICT (url) DO UPDATE SET
+                    checked_at = excluded.checked_at,
+                    success = excluded.success,
+                    reason = excluded.reason,
+                    failures = excluded.failures,
+                    next_retry_at = excluded.next_retry_at
+                """,
+                (url, int(success), reason, failures, time.time() + delay if delay else None),
+            )
+            return delay
+
+        return self._write(record_feed_status)
+
+    def get_backed_off_feeds(self) -> List[str]:
+        rows = self._read(
+            "SELECT url FROM feed_status WHERE success = 0 AND next_retry_at > %s", (time.time(),)
+        )
+        return [row[0] for row in rows]
+
+    def get_feed_validators(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+        rows = self._read("SELECT etag, last_modified FROM feed_validators WHERE url = %s", (url,))
+        return (rows[0][0], rows[0][1]) if rows else (None, None)
+
+    def store_feed_validators(self, url: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        def store_feed_validators(conn: Connection) -> None:
+            conn.execute(
+                """
+                INSERT INTO feed_validators (url, etag, last_modified)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (url) DO UPDATE SET
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified
+                """,
+                (url, etag, last_modified),
+            )
+
+        self._write(store_feed_validators)
+
+    def get_feed_watermark(self, url: str) -> Tuple[Optional[str], Optional[float]]:
+        rows = self._read(
+            "SELECT last_guid, last_published FROM feed_watermarks WHERE url = %s", (url,)
+        )
+        return (rows[0][0], rows[0][1]) if rows else (None, None)
+
+    def store_feed_watermark(
+        self, url: str, last_guid: Optional[str], last_published: Optional[float]
+    ) -> None:
+        def store_feed_watermark(conn: Connection) -> None:
+            conn.execute(
+                f"""
+                INSERT INTO feed_watermarks (url, last_guid, last_published, updated_at)
+                VALUES (%s, %s, %s, {_NOW_TEXT})
+                ON CONFLICT (url) DO UPDATE SET
+                    last_guid = excluded.last_guid,
+                    last_published = excluded.last_published,
+                    updated_at = excluded.updated_at
+                """,
+                (url, last_guid, last_published),
+            )
+
+        self._write(store_feed_watermark)
+
+    def get_feed_schedules(self) -> Dict[str, Dict[str, Optional[float]]]:
+        rows = self._read(
+            "SELECT url, next_poll_at, interval, publish_interval, last_polled_at FROM feed_schedule"
+        )
+        return {
+            row[0]: {
+                "next_poll_at": row[1],
+                "interval": row[2],
+                "publish_interval": row[3],
+                "last_polled_at": row[4],
+            }
+            for row in rows
+        }
+
+    def store_feed_schedule(
+        self,
+        url: str,
+        next_poll_at: float,
+        interval: float,
+        publish_interval: Optional[float] = None,
+        last_polled_at: Optional[float] = None,
+    ) -> None:
+        def store_feed_schedule(conn: Connection) -> None:
+            conn.execute(
+                """
+                INSERT INTO feed_schedule (url, next_poll_at, interval, publish_interval, last_polled_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (url) DO UPDATE SET
+                    next_poll_at = excluded.next_poll_at,
+                    interval = excluded.interval,
+                    publish_interval = excluded.publish_interval,
+                    last_polled_at = excluded.last_polled_at
+                """,
+                (url, next_poll_at, interval, publish_interval, last_polled_at),
+            )
+
+        self._write(store_feed_schedule)
+
+    # Rewrite jobs
+
+    def enqueue_rewrite_jobs(
+        self,
+        articles: List[Dict[str, Any]],
+        source: str = "",
+        duplicate_max_distance: int = -1,
+        duplicate_window: float = 30 * 24 * 3600,
+    ) -> List[bool]:
+        if not articles:
+            return []
+        now = time.time()
+        fingerprints = [
+            simhash.simhash(a.get("summary", "")) if duplicate_max_distance >= 0 else None
+            for a in articles
+        ]
+
+        def enqueue_rewrite_jobs(conn: Connection) -> List[bool]:
+            flags = self._insert_processed(conn, articles)
+            jobs = []
+            for article, fingerprint, new in zip(articles, fingerprints, flags):
+                if not new:
+                    continue
+                article_hash = compute_hash(article["title"], article.get("date", ""))
+                if fingerprint is not None:
+                    fingerprint = simhash.to_signed(fingerprint)
+                    candidates = conn.execute(
+                        """
+                        SELECT DISTINCT s.hash, s.simhash FROM article_simhash_buckets b
+                        JOIN article_simhash s ON s.hash = b.hash
+                        WHERE b.bucket = ANY(%s) AND s.created_at >= %s
+                        """,
+                        (simhash.buckets(fingerprint), now - duplicate_window),
+                    ).fetchall()
+                    match = simhash.closest(fingerprint, candidates, duplicate_max_distance)
+                    if match:
+                        conn.execute(
+                            """
+                            INSERT INTO article_duplicates
+                                (hash, duplicate_of, link, source, distance, created_at)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (hash) DO NOTHING
+                            """,
+                            (article_hash, match[0], article["link"], source, match[1], now),
+                        )
+                        NEAR_DUPLICATES.inc()
+                        continue
+                    conn.execute(
+                        """
+                        INSERT INTO article_simhash (hash, simhash, created_at) VALUES (%s, %s, %s)
+                        ON CONFLICT (hash) DO NOTHING
+                        """,
+                        (article_hash, fingerprint, now),
+                    )
+                    conn.execute(
+                        """
+                        INSERT INTO article_simhash_buckets (bucket, hash)
+                        SELECT unnest(%s::bigint[]), %s
+                        ON CONFLICT DO NOTHING
+                        """,
+                        (simhash.buckets(fingerprint), article_hash),
+                    )
+                jobs.append((article_hash, json.dumps(article)))
+            if jobs:
+                conn.execute(
+                    """
+                    INSERT INTO rewrite_jobs (hash, source, article, status, created_at, updated_at)
+                    SELECT h, %s, a, %s, %s, %s FROM unnest(%s::text[], %s::text[]) AS j(h, a)
+                    ON CONFLICT (hash) DO NOTHING
+                    """,
+                    (
+                        source,
+                        JOB_PENDING,
+                        now,
+                        now,
+                        [h for h, _ in jobs],
+                        [a for _, a in jobs],
+                    ),
+                )
+            return flags
+
+        return self._write(enqueue_rewrite_jobs)
+
+    def get_duplicate_of(self, article_hash: str) -> Optional[str]:
+        rows = self._read(
+            "SELECT duplicate_of FROM article_duplicates WHERE hash = %s", (article_hash,)
+        )
+        return rows[0][0] if rows else None
+
+    def prune_article_simhashes(self, max_age: float) -> int:
+        cutoff = time.time() - max_age
+
+        def prune_article_simhashes(conn: Connection) -> int:
+            conn.execute(
+                """
+                DELETE FROM article_simhash_buckets
+                WHERE hash IN (SELECT hash FROM article_simhash WHERE created_at < %s)
+                """,
+                (cutoff,),
+            )
+            return conn.execute(
+                "DELETE FROM article_simhash WHERE created_at < %s", (cutoff,)
+            ).rowcount
+
+        return self._write(prune_article_simhashes)
+
+    def claim_rewrite_jobs(
+        self,
+        limit: int,
+        lease: float,
+        max_attempts: int,
+        hashes: Optional[List[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        if hashes is not None and not hashes:
+            return []
+        now = time.time()
+
+        def claim_rewrite_jobs(conn: Connection) -> List[Dict[str, Any]]:
+            conn.execute(
+                """
+                UPDATE rewrite_jobs SET status = %s, last_error = 'lease expired', updated_at = %s
+                WHERE status = %s AND lease_until < %s AND attempts >= %s
+                """,
+                (JOB_FAILED, now, JOB_IN_PROGRESS, now, max_attempts),
+            )
+            query = """
+                SELECT id FROM rewrite_jobs
+                WHERE ((status = %s AND (lease_until IS NULL OR lease_until <= %s))
+                   OR (status = %s AND lease_until < %s))
+            """
+            params: list = [JOB_PENDING, now, JOB_IN_PROGRESS, now]
+            if hashes is not None:
+                query += " AND hash = ANY(%s)"
+                params.append(hashes)
+            # Rows locked by another claimer are skipped rather than waited for.
+            query += " ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+            params.append(limit)
+            rows = conn.execute(
+                f"""
+                UPDATE rewrite_jobs SET status = %s, attempts = attempts + 1,
+                    lease_until = %s, updated_at = %s
+                WHERE id IN ({query})
+                RETURNING id, hash, source, article, attempts
+                """,
+                [JOB_IN_PROGRESS, now + lease, now, *params],
+            ).fetchall()
+            return [
+                {
+                    "id": row[0],
+                    "hash": row[1],
+                    "source": row[2],
+                    "article": json.loads(row[3]),
+                    "attempts": row[4],
+                }
+                for row in sorted(rows)
+            ]
+
+        return self._write(claim_rewrite_jobs)
+
+    def complete_rewrite_jobs(self, results: List[Tuple[int, Dict[str, str]]]) -> int:
+        if not results:
+            return 0
+        rows = _rewritten_rows([row for _, row in results])
+        now = time.time()
+
+        def complete_rewrite_jobs(conn: Connection) -> int:
+            stored = self._insert_rewritten(conn, rows)
+            conn.execute(
+                """
+                UPDATE rewrite_jobs SET status = %s, lease_until = NULL, last_error = NULL, updated_at = %s
+                WHERE id = ANY(%s)
+                """,
+                (JOB_DONE, now, [job_id for job_id, _ in results]),
+            )
+            return stored
+
+        stored = self._write(complete_rewrite_jobs)
+        if stored:
+            events.publish()
+        return stored
+
+    def fail_rewrite_job(self, job_id: int, error: str, max_attempts: int, retry_delay: float) -> bool:
+        now = time.time()
+
+        def fail_rewrite_job(conn: Connection) -> bool:
+            row = conn.execute(
+                "SELECT attempts FROM rewrite_jobs WHERE id = %s FOR UPDATE", (job_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            attempts = row[0]
+            retry = attempts < max_attempts
+            conn.execute(
+                """
+                UPDATE rewrite_jobs SET status = %s, lease_until = %s, last_error = %s, updated_at = %s
+                WHERE id = %s
+                """,
+                (
+                    JOB_PENDING if retry else JOB_FAILED,
+                    now + backoff_delay(attempts, retry_delay, 24 * 3600) if retry else None,
+                    error,
+                    now,
+                    job_id,
+                ),
+            )
+            return retry
+
+        return self._write(fail_rewrite_job)
+
+    def release_rewrite_jobs(self, job_ids: List[int], delay: float = 0.0) -> None:
+        if not job_ids:
+            return
+        now = time.time()
+
+        def release_rewrite_jobs(conn: Connection) -> None:
+            conn.execute(
+                """
+                UPDATE rewrite_jobs
+                SET status = %s, attempts = GREATEST(attempts - 1, 0), lease_until = %s, updated_at = %s
+                WHERE id = ANY(%s) AND status = %s
+                """,
+                (JOB_PENDING, now + delay, now, job_ids, JOB_IN_PROGRESS),
+            )
+
+        self._write(release_rewrite_jobs)
+
+    def prune_rewrite_jobs(self, max_age: float) -> int:
+        cutoff = time.time() - max_age
+
+        def prune_rewrite_jobs(conn: Connection) -> int:
+            return conn.execute(
+                "DELETE FROM rewrite_jobs WHERE status = %s AND updated_at < %s", (JOB_DONE, cutoff)
+            ).rowcount
+
+        return self._write(prune_rewrite_jobs)
+
+    # Rewrite cache
+
+    def get_cached_rewrite(self, key: str) -> Optional[str]:
+        # The usage bookkeeping rides along with the lookup in one statement.
+        def get_cached_rewrite(conn: Connection) -> Optional[tuple]:
+            return conn.execute(
+                """
+                UPDATE rewrite_cache SET hits = hits + 1, last_used_at = %s
+                WHERE key = %s RETURNING content
+                """,
+                (time.time(), key),
+            ).fetchone()
+
+        row = self._write(get_cached_rewrite)
+        if row is None:
+            REWRITE_CACHE_LOOKUPS.labels(result="miss").inc()
+            return None
+        REWRITE_CACHE_LOOKUPS.labels(result="hit").inc()
+        return row[0]
+
+    def store_cached_rewrite(self, key: str, model_name: str, content: str) -> None:
+        now = time.time()
+
+        def store_cached_rewrite(conn: Connection) -> None:
+            conn.execute(
+                """
+                INSERT INTO rewrite_cache (key, model, content, created_at, last_used_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (key) DO UPDATE SET
+                    content = excluded.content,
+                    last_used_at = excluded.last_used_at
+                """,
+                (key, model_name, content, now, now),
+            )
+
+        self._write(store_cached_rewrite)
+
+    def prune_rewrite_cache(self, max_entries: int, max_age: float) -> int:
+        def prune_rewrite_cache(conn: Connection) -> int:
+            removed = conn.execute(
+                "DELETE FROM rewrite_cache WHERE last_used_at < %s", (time.time() - max_age,)
+            ).rowcount
+            removed += conn.execute(
+                """
+                DELETE FROM rewrite_cache WHERE key IN (
+                    SELECT key FROM rewrite_cache
+                    ORDER BY last_used_at DESC
+                    OFFSET %s
+                )
+                """,
+                (max_entries,),
+            ).rowcount
+            return removed
+
+        return self._write(prune_rewrite_cache)
@@ -0,0 +1,255 @@
+"""Long-running feed poller with a per-feed schedule.
+
+Every feed gets its own next poll time in the ``feed_schedule`` table instead
+of sharing the global ``[RSS] interval``. The interval follows the feed's
+observed publish rate, respects the publisher's ``<ttl>``, ``Cache-Control``
+and ``Retry-After`` hints, and is jittered so feeds do not fire together. Poll
+starts are additionally capped at ``max_polls_per_minute``.
+
+    python poll_scheduler.py --config config.ini
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from configparser import ConfigParser
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from db import (
+    get_feed_schedules,
+    prune_article_simhashes,
+    prune_rewrite_cache,
+    prune_rewrite_jobs,
+    store_feed_schedule,
+)
+from feed_manager import (
+    CONFIG_PATH,
+    FetchConfig,
+    HostLimiter,
+    build_http_client,
+    fetch_and_store,
+    parse_feed_config,
+)
+from llm_client import LLMClient, LLMConfig
+import settings
+from settings import read_config
+from rewriter import drain_rewrite_jobs
+from rss_parser import FeedFetchResult
+
+# A feed is polled this many times per expected new entry
+POLLS_PER_ENTRY = 2
+# Interval growth after a poll that found nothing new
+IDLE_BACKOFF = 1.5
+# Weight of the latest observation in the publish interval estimate
+SMOOTHING = 0.5
+# Seconds between rewrite cache prunes
+PRUNE_INTERVAL = 3600
+# Longest sleep between checks for due feeds, so feed list edits are picked up
+MAX_IDLE = 60
+
+
+@dataclass(frozen=True)
+class PollConfig:
+    interval: float = 3600.0
+    min_interval: float = 300.0
+    max_interval: float = 86400.0
+    jitter: float = 0.1
+    max_polls_per_minute: int = 30
+
+    @classmethod
+    def load(cls, path: Path = CONFIG_PATH, section: str = "RSS") -> "PollConfig":
+        return cls.from_parser(read_config(path), path, section)
+
+    @classmethod
+    def from_parser(
+        cls, parser: ConfigParser, path: Path = CONFIG_PATH, section: str = "RSS"
+    ) -> "PollConfig":
+        return cls(
+            interval=parser.getfloat(section, "interval", fallback=cls.interval),
+            min_interval=parser.getfloat(section, "min_poll_interval", fallback=cls.min_interval),
+            max_interval=parser.getfloat(section, "max_poll_interval", fallback=cls.max_interval),
+            jitter=parser.getfloat(section, "poll_jitter", fallback=cls.jitter),
+            max_polls_per_minute=parser.getint(
+                section, "max_polls_per_minute", fallback=cls.max_polls_per_minute
+            ),
+        )
+
+
+def estimate_publish_interval(articles: List[dict], now: float) -> Optional[float]:
+    """Typical gap between entries, from the feed's own timestamps.
+
+    The age of the newest entry is used as a lower bound, so a feed that
+    published a burst long ago does not count as busy.
+    """
+    stamps = sorted(
+        (a["published_ts"] for a in articles if a.get("published_ts") is not None), reverse=True
+    )
+    if not stamps:
+        return None
+    age = max(0.0, now - stamps[0])
+    gaps = [newer - older for newer, older in zip(stamps, stamps[1:]) if newer > older]
+    if not gaps:
+        return age or None
+    return max(statistics.median(gaps), age)
+
+
+def next_interval(
+    result: FeedFetchResult, schedule: Optional[dict], config: PollConfig, now: float
+) -> Tuple[float, Optional[float]]:
+    """Return the interval until the next poll and the updated publish estimate."""
+    schedule = schedule or {}
+    previous = schedule.get("interval") or config.interval
+    publish = schedule.get("publish_interval")
+    if not result.ok:
+        # The failure backoff arrives as retry_after, see fetch_and_store.
+        interval = previous
+    elif result.not_modified:
+        interval = previous * IDLE_BACKOFF
+        if publish:
+            interval = min(interval, publish / POLLS_PER_ENTRY)
+    else:
+        observed = estimate_publish_interval(result.articles, now)
+        if observed:
+            publish = observed if publish is None else SMOOTHING * observed + (1 - SMOOTHING) * publish
+        interval = publish / POLLS_PER_ENTRY if publish else config.interval
+    interval = min(max(interval, config.min_interval), config.max_interval)
+    # The publisher's hints are floors. Retry-After, which also carries the
+    # failure backoff, may exceed max_interval.
+    hints = [hint for hint in (result.ttl, result.max_age) if hint]
+    if hints:
+        interval = max(interval, min(max(hints), config.max_interval))
+    if result.retry_after:
+        interval = max(interval, result.retry_after)
+    return interval, publish
+
+
+def jittered(interval: float, jitter: float) -> float:
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+class PollRateLimiter:
+    """Spaces poll starts so that at most ``per_minute`` begin each minute."""
+
+    def __init__(self, per_minute: int):
+        self._spacing = 60.0 / max(1, per_minute)
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self._spacing
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def schedule_new_feeds(
+    feeds: List[str], schedules: Dict[str, dict], config: PollConfig, now: float
+) -> None:
+    """Give feeds without a schedule a random first poll time.
+
+    The start times are spread over the time the rate cap needs for them
+    anyway, so a fresh start does not fire every feed at once.
+    """
+    new = [url for url in feeds if url not in schedules]
+    spread = min(config.interval, 60.0 * len(new) / max(1, config.max_polls_per_minute))
+    for url in new:
+        next_poll_at = now + random.uniform(0, spread)
+        store_feed_schedule(url, next_poll_at, config.interval)
+        schedules[url] = {
+            "next_poll_at": next_poll_at,
+            "interval": config.interval,
+            "publish_interval": None,
+            "last_polled_at": None,
+        }
+
+
+async def run_scheduler(config_path: Path = CONFIG_PATH) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    logging.info("Poll scheduler started")
+    settings.reload_on_sighup()
+    config = settings.snapshot(config_path)
+    # The HTTP and LLM clients keep the settings they were started with.
+    fetch_config = config.get(FetchConfig.from_parser)
+    llm_config = config.get(LLMConfig.from_parser)
+    poll_config = config.get(PollConfig.from_parser)
+    limiter = HostLimiter(fetch_config.max_concurrency, fetch_config.per_host_concurrency)
+    rate = PollRateLimiter(poll_config.max_polls_per_minute)
+    running: Dict[str, asyncio.Task] = {}
+    drain: Optional[asyncio.Task] = None
+    last_prune = time.time()
+
+    async with build_http_client(fetch_config) as http, LLMClient(llm_config) as llm:
+
+        async def poll(url: str, schedule: Optional[dict]) -> None:
+            try:
+                try:
+                    result = await fetch_and_store(url, http, limiter, llm, fetch_config)
+                except Exception as exc:
+                    logging.error("Failed to poll %s: %s", url, exc)
+                    result = FeedFetchResult(False, str(exc))
+                now = time.time()
+                interval, publish = next_interval(result, schedule, poll_config, now)
+                next_poll_at = now + jittered(interval, poll_config.jitter)
+                await asyncio.to_thread(
+                    store_feed_schedule, url, next_poll_at, interval, publish, now
+                )
+                logging.info("Next poll of %s in %.0f seconds", url, next_poll_at - now)
+            finally:
+                running.pop(url, None)
+
+        while True:
+            config = settings.snapshot(config_path)
+            feeds, _ = config.get(parse_feed_config)
+            poll_config = config.get(PollConfig.from_parser)
+            schedules = await asyncio.to_thread(get_feed_schedules)
+            await asyncio.to_thread(schedule_new_feeds, feeds, schedules, poll_config, time.time())
+            active = [url for url in feeds if url not in running]
+            due = sorted(
+                (url for url in active if schedules[url]["next_poll_at"] <= time.time()),
+                key=lambda url: schedules[url]["next_poll_at"],
+            )
+            for url in due:
+                await rate.wait()
+                running[url] = asyncio.create_task(poll(url, schedules[url]))
+
+            # Retry failed rewrites and pick up jobs left by a crashed run.
+            if drain is None or drain.done():
+                drain = asyncio.create_task(drain_rewrite_jobs(llm))
+
+            if time.time() - last_prune >= PRUNE_INTERVAL:
+                last_prune = time.time()
+                await asyncio.to_thread(prune_rewrite_jobs, llm_config.job_retention)
+                await asyncio.to_thread(prune_article_simhashes, llm_config.duplicate_window)
+                pruned = await asyncio.to_thread(
+                    prune_rewrite_cache,
+                    llm_config.rewrite_cache_max_entries,
+                    llm_config.rewrite_cache_max_age,
+                )
+                if pruned:
+                    logging.info("Pruned %d rewrite cache entries", pruned)
+
+            upcoming = [schedules[url]["next_poll_at"] for url in active if url not in due]
+            delay = min([MAX_IDLE] + [at - time.time() for at in upcoming])
+            await asyncio.sleep(max(delay, 1.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poll RSS feeds on adaptive per-feed schedules")
+    parser.add_argument(
+        "--config", type=Path, default=CONFIG_PATH, help="Path to configuration file"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port while running",
+    )
+    args = parser.parse_args()
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+
+        start_http_server(args.metrics_port)
+    asyncio.run(run_scheduler(args.config))
@@ -0,0 +1,134 @@
+"""Cleanup of feed summaries before they are put into a prompt.
+
+Feeds often ship their summary as HTML with images, scripts, share buttons,
+"The post ... appeared first on ..." footers or even the full article. The
+summary is reduced to plain text without that boilerplate and cut to the
+model's input token budget, since prompt length drives LLM latency.
+
+Token counts are estimates of :data:`CHARS_PER_TOKEN` characters per token;
+no model tokenizer is needed.
+"""
+import math
+import re
+from html.parser import HTMLParser
+from typing import List
+
+from metrics import PROMPT_INPUT_TOKENS, PROMPT_TOKENS_SAVED, PROMPT_TRUNCATED
+
+CHARS_PER_TOKEN = 4
+ELLIPSIS = " …"
+
+# Elements whose content is never article text
+_SKIP_TAGS = {
+    "script", "style", "noscript", "iframe", "svg", "figure", "form", "button",
+    "nav", "footer", "aside", "template", "object", "video", "audio",
+}
+# Elements that end a line of text
+_BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6",
+    "tr", "table", "blockquote", "pre", "section", "article", "header", "hr", "dd", "dt",
+}
+_VOID_TAGS = {"br", "hr", "img", "input", "meta", "link", "source", "wbr", "area", "col", "embed"}
+
+# Lines that are feed or site chrome rather than content
+_BOILERPLATE = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"^the post .+ appeared first on .+$",
+        r"^(continue|keep) reading\b.{0,80}$",
+        r"^read (more|the (full|rest of the) (story|article|post))\b.{0,80}$",
+        r"^(share|tweet|follow us|subscribe)\b.{0,80}$",
+        r"^(click|tap) here\b.{0,80}$",
+        r"^(\[(…|\.\.\.)\]|…|\.\.\.)$",
+    )
+]
+# WordPress style "[…]" excerpt markers inside a line
+_ELIDED = re.compile(r"\s*\[(…|\.\.\.|&hellip;)\]")
+_SPACE = re.compile(r"[ \t\r\f\v\u00a0]+")
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag == "li" and not self._skip:
+            self.parts.append("- ")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _BLOCK_TAGS and tag not in _VOID_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(text: str) -> str:
+    """Convert an HTML fragment to text, one line per block element."""
+    if "<" not in text and "&" not in text:
+        return text
+    parser = _TextExtractor()
+    parser.feed(text)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def strip_boilerplate(text: str) -> str:
+    """Collapse whitespace and drop empty, repeated and boilerplate lines."""
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = _SPACE.sub(" ", _ELIDED.sub("", line)).strip()
+        if not line or line in seen or any(p.match(line) for p in _BOILERPLATE):
+            continue
+        seen.add(line)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    """Cut ``text`` to about ``budget`` tokens, at a sentence or word boundary if possible."""
+    limit = budget * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[: max(0, limit - len(ELLIPSIS))]
+    # Prefer ending on a full sentence unless that drops too much.
+    sentence = max(cut.rfind(". "), cut.rfind(".\n"), cut.rfind("\n"))
+    if sentence >= len(cut) * 0.8:
+        return cut[: sentence + 1].rstrip() + ELLIPSIS
+    space = cut.rfind(" ")
+    if space > 0:
+        cut = cut[:space]
+    return cut.rstrip() + ELLIPSIS
+
+
+def clean_summary(summary: str, budget: int, model: str) -> str:
+    """Return ``summary`` as plain text within ``budget`` tokens and record the savings."""
+    text = strip_boilerplate(html_to_text(summary or ""))
+    if budget > 0:
+        truncated = truncate_tokens(text, budget)
+        if truncated is not text:
+            PROMPT_TRUNCATED.labels(model=model).inc()
+        text = truncated
+    before = estimate_tokens(summary or "")
+    after = estimate_tokens(text)
+    PROMPT_INPUT_TOKENS.labels(model=model).observe(after)
+    PROMPT_TOKENS_SAVED.labels(model=model).inc(max(0, before - after))
+    return text
@@ -0,0 +1,34 @@
+"""Server-side rendering of the Markdown produced by the LLM.
+
+Rewrites are rendered once when they are stored and the sanitized HTML is kept
+next to the raw Markdown, so pages can serve it as is.
+"""
+import threading
+
+import markdown
+import nh3
+
+MARKDOWN_EXTENSIONS = ["extra", "sane_lists"]
+URL_SCHEMES = {"http", "https", "mailto"}
+
+_local = threading.local()
+
+
+def _markdown() -> markdown.Markdown:
+    # Markdown instances keep state between calls and are not thread-safe.
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = _local.md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return md
+
+
+def render_markdown(text: str) -> str:
+    """Render ``text`` to HTML with scripts, event handlers and unsafe links removed."""
+    if not text:
+        return ""
+    md = _markdown()
+    try:
+        html = md.convert(text)
+    finally:
+        md.reset()
+    return nh3.clean(html, url_schemes=URL_SCHEMES)
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from circuit import CircuitOpen
+from db import (
+    claim_rewrite_jobs,
+    complete_rewrite_jobs,
+    compute_rewrite_key,
+    fail_rewrite_job,
+    get_cached_rewrite,
+    release_rewrite_jobs,
+    store_cached_rewrite,
+)
+from llm_client import LLMClient
+from llm_scheduler import BACKGROUND, SchedulerOverloaded, get_scheduler, lane_timeout
+from metrics import LLM_BATCH_ARTICLES, LLM_BATCH_FALLBACKS
+from preprocess import clean_summary, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+BATCH_PROMPT = (
+    "Below are {count} articles, each headed by its id. Handle every article on its "
+    "own according to these instructions, where {{title}} and {{summary}} stand for "
+    "the article's title and text:\n\n{instructions}\n\n"
+    "Reply with one JSON object and nothing else. Its keys are the article ids and "
+    'its values the result for that article as a string, e.g. {{"1": "...", "2": "..."}}.'
+    "\n\n{articles}"
+)
+BATCH_ARTICLE = "### Article {id}\nTitle: {title}\n\n{summary}\n"
+
+
+def render_prompt(prompt_template: str, article: dict) -> str:
+    return prompt_template.format(title=article["title"], summary=article["summary"])
+
+
+def prepare_article(article: dict, llm: LLMClient) -> dict:
+    """Copy of ``article`` with its summary cleaned up for the model's prompt."""
+    config = llm.config
+    summary = clean_summary(article.get("summary", ""), config.input_budget(), config.model_name)
+    return {**article, "summary": summary}
+
+
+def rewrite_key(article: dict, llm: LLMClient, prompt_template: str) -> str:
+    return compute_rewrite_key(article.get("summary", ""), llm.config.model_name, prompt_template)
+
+
+async def rewrite_text(
+    article: dict,
+    llm: LLMClient,
+    prompt_template: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    priority: int = BACKGROUND,
+) -> str:
+    """Return the rewrite for ``article``, from the rewrite cache if possible.
+
+    Model calls go through the process-wide :class:`LLMScheduler` in the
+    given ``priority`` lane. When ``on_token`` is given and the model has to
+    be called, the rewrite is streamed and every raw token is passed to it as
+    it arrives.
+    """
+    article = prepare_article(article, llm)
+    key = rewrite_key(article, llm, prompt_template)
+    cached = await asyncio.to_thread(get_cached_rewrite, key)
+    if cached is not None:
+        logger.debug("Rewrite cache hit for %s", article["title"])
+        return cached
+
+    prompt = render_prompt(prompt_template, article)
+
+    async def generate() -> str:
+        if on_token is None:
+            return await llm.agenerate(prompt)
+        tokens: List[str] = []
+        async for token in llm.astream(prompt):
+            tokens.append(token)
+            on_token(token)
+        return llm.clean_output("".join(tokens))
+
+    scheduler = get_scheduler(llm.config)
+    rewritten = await scheduler.run(generate, priority, lane_timeout(llm.config, priority))
+    await asyncio.to_thread(store_cached_rewrite, key, llm.config.model_name, rewritten)
+    return rewritten
+
+
+def rewrite_text_sync(article: dict, llm: LLMClient, prompt_template: str) -> str:
+    """Blocking variant of :func:`rewrite_text` for the Celery worker."""
+    article = prepare_article(article, llm)
+    key = rewrite_key(article, llm, prompt_template)
+    cached = get_cached_rewrite(key)
+    if cached is not None:
+        logger.debug("Rewrite cache hit for %s", article["title"])
+        return cached
+    prompt = render_prompt(prompt_template, article)
+    scheduler = get_scheduler(llm.config)
+    with scheduler.slot_sync(BACKGROUND, lane_timeout(llm.config, BACKGROUND)):
+        rewritten = llm.generate(prompt)
+    store_cached_rewrite(key, llm.config.model_name, rewritten)
+    return rewritten
+
+
+def _batch_block(index: int, article: dict) -> str:
+    return BATCH_ARTICLE.format(id=index + 1, title=article["title"], summary=article["summary"])
+
+
+def pack_batches(articles: List[dict], max_articles: int, max_tokens: int) -> List[List[int]]:
+    """Group article indexes into batches of at most ``max_articles`` articles
+    and about ``max_tokens`` tokens of article text, in order."""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    size = 0
+    for index, article in enumerate(articles):
+        tokens = estimate_tokens(_batch_block(index, article))
+        if current and (len(current) >= max_articles or size + tokens > max_tokens):
+            batches.append(current)
+            current, size = [], 0
+        current.append(index)
+        size += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def render_batch_prompt(prompt_template: str, articles: List[dict]) -> str:
+    instructions = prompt_template.format(title="{title}", summary="{summary}")
+    return BATCH_PROMPT.format(
+        count=len(articles),
+        instructions=instructions,
+        articles="\n".join(_batch_block(i, a) for i, a in enumerate(articles)),
+    )
+
+
+def parse_batch_response(text: str, count: int) -> Dict[int, str]:
+    """Return the valid results of a batch response by article position.
+
+    Articles whose id is missing or whose result is not a non-empty string
+    are left out, so they can be retried on their own.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return {}
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    results = {}
+    for index in range(count):
+        value = data.get(str(index + 1))
+        if isinstance(value, str) and value.strip():
+            results[index] = value.strip()
+    return results
+
+
+async def rewrite_batched(
+    articles: List[dict], llm: LLMClient, prompt_template: str, priority: int = BACKGROUND
+) -> Dict[int, str]:
+    """Rewrite articles several to a prompt, as configured by ``batch_max_articles``.
+
+    Cached rewrites are used as they are. Returns the rewrites that succeeded
+    by article position; the caller rewrites the rest one by one.
+    """
+    config = llm.config
+    prepared = [prepare_article(article, llm) for article in articles]
+    keys = [rewrite_key(article, llm, prompt_template) for article in prepared]
+    cached = await asyncio.to_thread(lambda: [get_cached_rewrite(key) for key in keys])
+    results = {i: content for i, content in enumerate(cached) if content is not None}
+    pending = [i for i in range(len(prepared)) if i not in results]
+    batches = pack_batches(
+        [prepared[i] for i in pending], config.batch_max_articles, config.batch_max_tokens
+    )
+    scheduler = get_scheduler(config)
+
+    async def run(batch: List[int]) -> None:
+        indexes = [pending[i] for i in batch]
+        prompt = render_batch_prompt(prompt_template, [prepared[i] for i in indexes])
+        try:
+            raw = await scheduler.run(
+                lambda: llm.agenerate(prompt), priority, lane_timeout(config, priority)
+            )
+        except Exception as exc:
+            logger.warning("Batched rewrite of %d articles failed: %s", len(indexes), exc)
+            LLM_BATCH_FALLBACKS.inc(len(indexes))
+            return
+        parsed = parse_batch_response(raw, len(indexes))
+        LLM_BATCH_ARTICLES.observe(len(indexes))
+        LLM_BATCH_FALLBACKS.inc(len(indexes) - len(parsed))
+        for position, content in parsed.items():
+            results[indexes[position]] = content
+            await asyncio.to_thread(
+                store_cached_rewrite, keys[indexes[position]], config.model_name, content
+            )
+
+    # Single articles gain nothing from the batch prompt.
+    await asyncio.gather(*(run(batch) for batch in batches if len(batch) > 1))
+    return results
+
+
+def rewrite_batched_sync(articles: List[dict], llm: LLMClient, prompt_template: str) -> Dict[int, str]:
+    """Blocking variant of :func:`rewrite_batched` for the Celery worker."""
+    config = llm.config
+    prepared = [prepare_article(article, llm) for article in articles]
+    keys = [rewrite_key(article, llm, prompt_template) for article in prepared]
+    results = {}
+    for i, key in enumerate(keys):
+        content = get_cached_rewrite(key)
+        if content is not None:
+            results[i] = content
+    pending = [i for i in range(len(prepared)) if i not in results]
+    scheduler = get_scheduler(config)
+    for batch in pack_batches(
+        [prepared[i] for i in pending], config.batch_max_articles, config.batch_max_tokens
+    ):
+        if len(batch) < 2:
+            continue
+        indexes = [pending[i] for i in batch]
+        prompt = render_batch_prompt(prompt_template, [prepared[i] for i in indexes])
+        try:
+            with scheduler.slot_sync(BACKGROUND, lane_timeout(config, BACKGROUND)):
+                raw = llm.generate(prompt)
+        except Exception as exc:
+            logger.warning("Batched rewrite of %d articles failed: %s", len(indexes), exc)
+            LLM_BATCH_FALLBACKS.inc(len(indexes))
+            continue
+        parsed = parse_batch_response(raw, len(indexes))
+        LLM_BATCH_ARTICLES.observe(len(indexes))
+        LLM_BATCH_FALLBACKS.inc(len(indexes) - len(parsed))
+        for position, content in parsed.items():
+            results[indexes[position]] = content
+            store_cached_rewrite(keys[indexes[position]], config.model_name, content)
+    return results
+
+
+def rewritten_row(article: dict, content: str) -> Dict[str, str]:
+    return {
+        "title": article["title"],
+        "link": article["link"],
+        "content": content,
+        "date": article.get("date", ""),
+    }
+
+
+def record_job_failure(job: Dict[str, Any], exc: Exception, llm: LLMClient) -> None:
+    """Return a claimed job whose rewrite raised ``exc`` to the queue."""
+    title = job["article"].get("title")
+    if isinstance(exc, (CircuitOpen, SchedulerOverloaded)):
+        # The model is unavailable or busy, which is not the job's fault, so
+        # the attempt is not counted.
+        delay = exc.retry_in if isinstance(exc, CircuitOpen) else llm.config.job_retry_delay
+        logger.warning("Postponing rewrite of %s: %s", title, exc)
+        release_rewrite_jobs([job["id"]], delay)
+        return
+    logger.error("Failed to rewrite %s from %s: %s", title, job["source"], exc)
+    fail_rewrite_job(
+        job["id"], str(exc) or type(exc).__name__, llm.config.job_max_attempts, llm.config.job_retry_delay
+    )
+
+
+async def run_rewrite_jobs(
+    jobs: List[Dict[str, Any]], llm: LLMClient, priority: int = BACKGROUND
+) -> int:
+    """Rewrite claimed jobs concurrently and record each outcome.
+
+    With ``batch_max_articles`` above 1 the jobs are first rewritten several
+    to a prompt, and only the articles missing from the batch answers are
+    rewritten one by one. Successful rewrites are stored and their jobs
+    marked done in one transaction; failed jobs go back to the queue for a
+    later attempt. Returns the number of articles stored.
+    """
+    batched: Dict[int, str] = {}
+    if llm.config.batch_max_articles > 1 and len(jobs) > 1:
+        batched = await rewrite_batched(
+            [job["article"] for job in jobs], llm, llm.config.rewrite_prompt, priority
+        )
+    done = {jobs[i]["id"]: content for i, content in batched.items()}
+
+    async def run(job: Dict[str, Any]) -> Optional[Tuple[int, Dict[str, str]]]:
+        article = job["article"]
+        if job["id"] in done:
+            return job["id"], rewritten_row(article, done[job["id"]])
+        try:
+            rewritten = await rewrite_text(article, llm, llm.config.rewrite_prompt, priority=priority)
+        except Exception as exc:
+            await asyncio.to_thread(record_job_failure, job, exc, llm)
+            return None
+        logger.info("Rewrote article from %s: %s", job["source"], article["title"])
+        return job["id"], rewritten_row(article, rewritten)
+
+    results = await asyncio.gather(*(run(job) for job in jobs))
+    return await asyncio.to_thread(complete_rewrite_jobs, [r for r in results if r is not None])
+
+
+async def drain_rewrite_jobs(llm: LLMClient) -> int:
+    """Work through every runnable job in batches of ``job_batch_size``.
+
+    Picks up jobs left behind by crashed or timed-out workers and jobs due
+    for a retry. Stops early while the circuit of every LLM endpoint is open.
+    """
+    config = llm.config
+    stored = 0
+    while llm.available():
+        jobs = await asyncio.to_thread(
+            claim_rewrite_jobs, config.job_batch_size, config.job_lease, config.job_max_attempts
+        )
+        if not jobs:
+            break
+        stored += await run_rewrite_jobs(jobs, llm)
+    return stored
+
+
+def run_rewrite_jobs_sync(jobs: List[Dict[str, Any]], llm: LLMClient) -> int:
+    """Blocking variant of :func:`run_rewrite_jobs` for the Celery worker."""
+    batched: Dict[int, str] = {}
+    if llm.config.batch_max_articles > 1 and len(jobs) > 1:
+        batched = rewrite_batched_sync(
+            [job["article"] for job in jobs], llm, llm.config.rewrite_prompt
+        )
+    results = []
+    for i, job in enumerate(jobs):
+        article = job["article"]
+        if i in batched:
+            results.append((job["id"], rewritten_row(article, batched[i])))
+            continue
+        try:
+            rewritten = rewrite_text_sync(article, llm, llm.config.rewrite_prompt)
+        except Exception as exc:
+            record_job_failure(job, exc, llm)
+            continue
+        results.append((job["id"], rewritten_row(article, rewritten)))
+    return complete_rewrite_jobs(results)
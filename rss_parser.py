@@ -1,23 +1,61 @@
+import asyncio
+import calendar
+import re
+import time
+from email.utils import parsedate_to_datetime
+
 import feedparser
-import requests
+import httpx
+from dataclasses import dataclass, field
 from typing import List, Dict, Tuple, Optional
 
+from metrics import FEED_FETCH_SECONDS, FEED_PARSE_SECONDS, feed_label, timed
+
 
 # Number of articles returned when no explicit limit is provided
 DEFAULT_LIMIT = 1
 
+USER_AGENT = "FeedPulse"
+
+
+@dataclass
+class FeedFetchResult:
+    """Outcome of a single (possibly conditional) feed fetch.
+
+    ``not_modified`` is set when the server answered 304, in which case no
+    articles are returned and the stored validators remain current.
+    ``ttl``, ``max_age`` and ``retry_after`` carry the publisher's polling
+    hints in seconds: the feed's ``<ttl>``, the ``Cache-Control`` max-age and
+    the ``Retry-After`` of an error response.
+    """
+
+    ok: bool
+    reason: str
+    articles: List[Dict[str, str]] = field(default_factory=list)
+    not_modified: bool = False
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    ttl: Optional[float] = None
+    max_age: Optional[float] = None
+    retry_after: Optional[float] = None
+
+
 def _get_date(entry) -> str:
     for key in ("published", "updated", "created", "pubDate"):
         if key in entry:
             return str(entry.get(key))
     return ""
 
-def parse_rss(
-    url: str,
-    limit: int = DEFAULT_LIMIT,
-    data: Optional[bytes] = None,
-) -> List[Dict[str, str]]:
-    feed = feedparser.parse(data if data is not None else url)
+
+def _get_timestamp(entry) -> Optional[float]:
+    for key in ("published_parsed", "updated_parsed", "created_parsed"):
+        parsed = entry.get(key)
+        if parsed:
+            return float(calendar.timegm(parsed))
+    return None
+
+
+def _extract_articles(feed, limit: Optional[int]) -> List[Dict[str, str]]:
     articles: List[Dict[str, str]] = []
     for entry in feed.entries[:limit]:
         articles.append({
@@ -25,25 +63,131 @@ def parse_rss(
             "link": entry.link,
             "summary": entry.summary if "summary" in entry else "",
             "date": _get_date(entry),
+            "guid": entry.get("id") or entry.link,
+            "published_ts": _get_timestamp(entry),
         })
     return articles
 
 
-def validate_feed(url: str, timeout: int = 10) -> Tuple[bool, str, Optional[bytes]]:
-    """Check if the given RSS feed is accessible and valid.
+def _check_parsed(feed) -> Tuple[bool, str]:
+    if feed.bozo:
+        return False, str(feed.bozo_exception)
+    if not feed.entries:
+        return False, "No entries found"
+    return True, "ok"
+
+
+def _parse(url: str, content) -> feedparser.FeedParserDict:
+    with timed(FEED_PARSE_SECONDS, feed=feed_label(url)):
+        return feedparser.parse(content)
+
+
+def _observe_fetch(url: str, start: float, outcome: str) -> None:
+    FEED_FETCH_SECONDS.labels(feed=feed_label(url), outcome=outcome).observe(
+        time.perf_counter() - start
+    )
+
+
+def parse_rss(
+    url: str,
+    limit: Optional[int] = DEFAULT_LIMIT,
+    data: Optional[bytes] = None,
+) -> List[Dict[str, str]]:
+    feed = _parse(url, data if data is not None else url)
+    return _extract_articles(feed, limit)
+
+
+def _max_age(headers) -> Optional[float]:
+    match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+    return float(match.group(1)) if match else None
+
+
+def _retry_after(headers) -> Optional[float]:
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _feed_ttl(parsed) -> Optional[float]:
+    # RSS <ttl> is given in minutes.
+    try:
+        return float(parsed.feed.get("ttl")) * 60
+    except (TypeError, ValueError):
+        return None
 
-    Returns a tuple of success flag, reason string and the fetched content if
-    successful.
+
+def conditional_headers(
+    etag: Optional[str] = None, last_modified: Optional[str] = None
+) -> Dict[str, str]:
+    headers = {"User-Agent": USER_AGENT}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+async def fetch_feed_async(
+    client: httpx.AsyncClient,
+    url: str,
+    limit: int = DEFAULT_LIMIT,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> FeedFetchResult:
+    """Fetch, validate and parse a feed with a shared ``httpx`` client.
+
+    The stored ``etag``/``last_modified`` validators are sent as a conditional
+    request; on a 304 the result is flagged ``not_modified`` and nothing is
+    parsed.
+
+    Timeouts and connection limits come from the client. Only the XML parse
+    is pushed to a worker thread.
     """
+    start = time.perf_counter()
     try:
-        resp = requests.get(url, timeout=timeout, headers={"User-Agent": "FeedPulse"})
+        resp = await client.get(url, headers=conditional_headers(etag, last_modified))
+        if resp.status_code == 304:
+            _observe_fetch(url, start, "not_modified")
+            return _not_modified(etag, last_modified, resp.headers)
         resp.raise_for_status()
-        content = resp.content
-        parsed = feedparser.parse(content)
-        if parsed.bozo:
-            return False, str(parsed.bozo_exception), None
-        if not parsed.entries:
-            return False, "No entries found", None
-        return True, "ok", content
+        _observe_fetch(url, start, "ok")
+        parsed = await asyncio.to_thread(_parse, url, resp.content)
+        return _build_result(parsed, limit, resp.headers)
+    except httpx.HTTPStatusError as exc:
+        _observe_fetch(url, start, "error")
+        return FeedFetchResult(False, str(exc), retry_after=_retry_after(exc.response.headers))
     except Exception as exc:
-        return False, str(exc), None
+        _observe_fetch(url, start, "error")
+        return FeedFetchResult(False, str(exc) or type(exc).__name__)
+
+
+def _not_modified(etag: Optional[str], last_modified: Optional[str], headers) -> FeedFetchResult:
+    return FeedFetchResult(
+        True,
+        "not modified",
+        not_modified=True,
+        etag=etag,
+        last_modified=last_modified,
+        max_age=_max_age(headers),
+    )
+
+
+def _build_result(parsed, limit: int, headers) -> FeedFetchResult:
+    ok, reason = _check_parsed(parsed)
+    if not ok:
+        return FeedFetchResult(False, reason)
+    return FeedFetchResult(
+        True,
+        reason,
+        articles=_extract_articles(parsed, limit),
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified"),
+        ttl=_feed_ttl(parsed),
+        max_age=_max_age(headers),
+    )
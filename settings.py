@@ -0,0 +1,167 @@
+"""Process-wide, hot-reloadable view of ``config.ini``.
+
+The file is parsed once per version into a :class:`ConfigSnapshot`. Callers
+ask a snapshot for the objects they need, built by a loader such as
+``LLMConfig.from_parser``, and every caller of the same snapshot shares the
+same frozen objects. Per-request variants are made with
+:func:`dataclasses.replace`.
+
+The file's modification time is checked at most every ``CHECK_INTERVAL``
+seconds, and SIGHUP forces a check. A changed file is parsed into a new
+snapshot, which replaces the current one in a single assignment, so requests
+already running keep the snapshot they started with. The new snapshot is
+built with every loader used so far. If any of them fails, for instance on
+a half-written file, the previous snapshot stays current.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+CONFIG_PATH = Path(__file__).resolve().parent / "config.ini"
+# Seconds between checks of the file's modification time
+CHECK_INTERVAL = 1.0
+
+# Builds a value from the parsed file; the path is for error messages.
+Loader = Callable[[ConfigParser, Path], Any]
+
+
+def read_config(path: Path) -> ConfigParser:
+    parser = ConfigParser(interpolation=None)
+    if not parser.read(path):
+        raise FileNotFoundError(f"Config file not found: {path}")
+    return parser
+
+
+def _stamp(path: Path) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigSnapshot:
+    """One parsed version of a configuration file."""
+
+    def __init__(self, path: Path, parser: ConfigParser, stamp: Tuple[int, int]):
+        self.path = path
+        self.stamp = stamp
+        self._parser = parser
+        self._values: Dict[Loader, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, loader: Loader) -> Any:
+        """Return what ``loader`` builds from this snapshot, building it once."""
+        try:
+            return self._values[loader]
+        except KeyError:
+            pass
+        with self._lock:
+            if loader not in self._values:
+                self._values[loader] = loader(self._parser, self.path)
+            return self._values[loader]
+
+    def loaders(self) -> Tuple[Loader, ...]:
+        with self._lock:
+            return tuple(self._values)
+
+
+class ConfigService:
+    """Hands out the current snapshot of one configuration file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._rejected: Optional[Tuple[int, int]] = None
+        self._checked = 0.0
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> ConfigSnapshot:
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and not self._stale
+            and time.monotonic() - self._checked < CHECK_INTERVAL
+        ):
+            return snapshot
+        with self._lock:
+            self._check()
+            return self._snapshot
+
+    def mark_stale(self) -> None:
+        """Check the file at the next :meth:`snapshot`, whatever its age."""
+        self._stale = True
+
+    def _check(self) -> None:
+        forced, self._stale = self._stale, False
+        self._checked = time.monotonic()
+        current = self._snapshot
+        try:
+            stamp = _stamp(self.path)
+        except OSError as exc:
+            if current is None:
+                raise FileNotFoundError(f"Config file not found: {self.path}") from exc
+            logging.error("Keeping the loaded configuration, cannot read %s: %s", self.path, exc)
+            return
+        if current is not None and not forced and stamp in (current.stamp, self._rejected):
+            return
+        try:
+            snapshot = ConfigSnapshot(self.path, read_config(self.path), stamp)
+            if current is not None:
+                # Fail here rather than in the requests that use the new file.
+                for loader in current.loaders():
+                    snapshot.get(loader)
+        except Exception as exc:
+            if current is None:
+                raise
+            self._rejected = stamp
+            logging.error("Keeping the loaded configuration, %s is invalid: %s", self.path, exc)
+            return
+        if current is not None:
+            logging.info("Reloaded configuration from %s", self.path)
+        self._rejected = None
+        self._snapshot = snapshot
+
+
+_services: Dict[Path, ConfigService] = {}
+_services_lock = threading.Lock()
+
+
+def service(path: Optional[Path] = None) -> ConfigService:
+    path = Path(path or CONFIG_PATH)
+    try:
+        return _services[path]
+    except KeyError:
+        pass
+    with _services_lock:
+        return _services.setdefault(path, ConfigService(path))
+
+
+def snapshot(path: Optional[Path] = None) -> ConfigSnapshot:
+    """The current snapshot of ``path``, ``config.ini`` by default."""
+    return service(path).snapshot()
+
+
+def get(loader: Loader, path: Optional[Path] = None) -> Any:
+    """Shortcut for ``snapshot(path).get(loader)``."""
+    return snapshot(path).get(loader)
+
+
+def reload_on_sighup() -> None:
+    """Make SIGHUP reload every configuration file at its next use.
+
+    Only the main thread can install signal handlers; elsewhere, and on
+    platforms without SIGHUP, changes are still picked up by modification
+    time.
+    """
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle(signum, frame) -> None:
+        for config_service in list(_services.values()):
+            config_service.mark_stale()
+
+    signal.signal(signal.SIGHUP, handle)
@@ -0,0 +1,77 @@
+"""SimHash fingerprints for spotting near-duplicate articles.
+
+Summaries are normalized to lowercase words, split into overlapping word
+shingles and folded into a 64-bit fingerprint. Fingerprints of texts that
+differ only slightly are a few bits apart. To find candidates without
+comparing against every stored fingerprint, each one is split into
+:data:`BANDS` 8-bit bands: two fingerprints at most ``BANDS - 1`` bits apart
+always share at least one band.
+
+Summaries are short, so a few edited words already move a fingerprint by 6-10
+bits while unrelated summaries stay 20 or more bits apart. Hence the word
+pairs as shingles and the narrow bands.
+"""
+import hashlib
+import re
+from typing import Iterable, List, Optional, Tuple
+
+BITS = 64
+BANDS = 8
+BAND_BITS = BITS // BANDS
+SHINGLE_SIZE = 2
+# Texts with fewer words give unreliable fingerprints and are not indexed
+MIN_WORDS = 20
+
+_TAG = re.compile(r"<[^>]+>")
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text: str) -> List[str]:
+    """Lowercase words of ``text`` with HTML tags removed."""
+    return _WORD.findall(_TAG.sub(" ", text).casefold())
+
+
+def simhash(text: str) -> Optional[int]:
+    """Return the 64-bit fingerprint of ``text``, or ``None`` if it is too short."""
+    words = normalize(text)
+    if len(words) < MIN_WORDS:
+        return None
+    weights = [0] * BITS
+    for i in range(len(words) - SHINGLE_SIZE + 1):
+        shingle = " ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8")
+        value = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), "big")
+        for bit in range(BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def distance(a: int, b: int) -> int:
+    """Number of differing bits between two fingerprints."""
+    return bin((a ^ b) & (2 ** BITS - 1)).count("1")
+
+
+def closest(
+    fingerprint: int, candidates: Iterable[Tuple[str, int]], max_distance: int
+) -> Optional[Tuple[str, int]]:
+    """Return the ``(key, distance)`` of the nearest candidate within ``max_distance`` bits."""
+    best = None
+    for key, other in candidates:
+        dist = distance(fingerprint, other)
+        if dist <= max_distance and (best is None or dist < best[1]):
+            best = (key, dist)
+    return best
+
+
+def buckets(fingerprint: int) -> List[int]:
+    """LSH bucket keys of a fingerprint, one per band, each tagged with its band number."""
+    mask = 2 ** BAND_BITS - 1
+    return [i << BAND_BITS | fingerprint >> (i * BAND_BITS) & mask for i in range(BANDS)]
+
+
+def to_signed(fingerprint: int) -> int:
+    """Map a fingerprint onto SQLite's signed 64-bit integers."""
+    return fingerprint - 2 ** BITS if fingerprint >= 2 ** (BITS - 1) else fingerprint
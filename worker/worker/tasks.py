@@ -1,14 +1,84 @@
+from typing import List, Optional
+
+from celery.signals import worker_process_init, worker_process_shutdown
+
 from . import app
 from llm_client import LLMClient, LLMConfig
-from rss_parser import parse_rss
-from db import store_rewritten_article, store_processed_article, compute_hash
-
-@app.task
-def rewrite_feed_article(article: dict):
-    config = LLMConfig.load()
-    with LLMClient(config) as llm:
-        prompt = config.rewrite_prompt.format(title=article['title'], summary=article['summary'])
-        result = llm.generate(prompt)
-    store_processed_article(article['title'], article['link'], article.get('date', ''))
-    store_rewritten_article(article['title'], article['link'], result, article.get('date', ''))
+from db import claim_rewrite_jobs, compute_hash, enqueue_rewrite_jobs
+from rewriter import run_rewrite_jobs_sync
+import settings
+
+# One client, and with it one HTTP connection pool, per worker process instead
+# of per task. It is replaced when config.ini changes.
+_llm: Optional[LLMClient] = None
+
+
+@worker_process_init.connect
+def init_worker(**kwargs):
+    global _llm
+    _llm = LLMClient(settings.get(LLMConfig.from_parser))
+
+
+@worker_process_shutdown.connect
+def shutdown_worker(**kwargs):
+    global _llm
+    if _llm is not None:
+        _llm.session.close()
+        _llm = None
+
+
+def get_llm() -> LLMClient:
+    """Return this process's client, creating it for pools without process init
+    and recreating it when the configuration has changed."""
+    global _llm
+    config = settings.get(LLMConfig.from_parser)
+    if _llm is None or _llm.config != config:
+        if _llm is not None:
+            _llm.session.close()
+        _llm = LLMClient(config)
+    return _llm
+
+
+@app.task(name="feedpulse.rewrite_articles_batch")
+def rewrite_articles_batch(articles: List[dict], source: str = ""):
+    """Rewrite many articles in one task.
+
+    Articles are queued as rewrite jobs if the producer has not done so
+    already. Only jobs that are still pending are claimed, so articles
+    rewritten before, or being rewritten by another worker, never reach the
+    LLM. The results are stored in one transaction.
+    """
+    llm = get_llm()
+    config = llm.config
+    enqueue_rewrite_jobs(
+        articles, source, config.duplicate_max_distance, config.duplicate_window
+    )
+    jobs = claim_rewrite_jobs(
+        len(articles),
+        config.job_lease,
+        config.job_max_attempts,
+        [compute_hash(a['title'], a.get('date', '')) for a in articles],
+    )
+    return run_rewrite_jobs_sync(jobs, llm)
+
+
+# Registered under its original default name, so messages already queued and
+# external producers keep working whichever package path imports this module.
+@app.task(name="worker.tasks.rewrite_feed_article")
+def rewrite_feed_article(article: dict, source: str = ""):
+    return rewrite_articles_batch([article], source)
+
 
+@app.task(name="feedpulse.drain_rewrite_jobs")
+def drain_rewrite_jobs():
+    """Work off every runnable job in the queue, including retries and
+    jobs abandoned by crashed workers."""
+    llm = get_llm()
+    config = llm.config
+    stored = 0
+    while llm.available():
+        jobs = claim_rewrite_jobs(config.job_batch_size, config.job_lease, config.job_max_attempts)
+        if not jobs:
+            break
+        stored += run_rewrite_jobs_sync(jobs, llm)
+    return stored